@@ -0,0 +1,388 @@
+# ds_archive.py
+#
+# Append-only on-disk archive of direct messages
+#
+# The data file is a magic line followed by one binary record per message: a fixed
+# header (timestamp, sender length, body length) and then the utf-8 sender and body.
+# A sidecar index file (<path>.idx) holds one fixed-size entry per record: its offset in
+# the data file, its timestamp and a sender number. Both files are only ever appended to
+# and are read through mmap, so opening a conversation or scanning a time range decodes
+# just the records it returns; the rest of the history stays on disk.
+#
+# The data file describes itself: if the index is lost or was not written completely
+# (e.g. a crash between the two appends) it is rebuilt from the data on open, and a
+# record cut short by a crash is dropped.
+#
+#     with Archive('history.dsa') as archive:
+#         archive.extend(messenger.iter_all())
+#         archive.conversation('friend')
+#         list(archive.scan(start=time.time() - 86400))
+
+import mmap
+import os
+import struct
+from array import array
+
+from ds_messenger import DirectMessage, to_timestamp
+
+MAGIC = b'DSARCH1\n'
+#timestamp, length of the sender, length of the body
+_RECORD = struct.Struct('<dHI')
+#offset of the record, timestamp, sender number
+_ENTRY = struct.Struct('<QdI')
+
+
+class Archive:
+    """
+    The Archive class appends messages to a binary archive file and reads them back by
+    correspondent or by time range.
+
+    In memory it keeps only the sender names and, per sender, an array of entry numbers
+    (4 bytes per message) in timestamp order. Timestamps and offsets are read from the
+    mapped index and message bodies from the mapped data file when they are asked for.
+    """
+    def __init__(self, path:str, fsync:bool = False):
+        """
+        Constructs all the necessary attributes for the Archive object and opens (or
+        creates) the archive.
+
+        :param path: data file; the index is kept next to it as path + ".idx"
+        :param fsync: fsync both files whenever extend returns
+        :type path: str
+        :type fsync: bool
+        :raises ValueError: path exists but is not an archive
+        """
+        self.path = path
+        self.index_path = path + '.idx'
+        self.fsync = fsync
+        self._names = []
+        self._name_ids = {}
+        #sender number -> entry numbers in timestamp order
+        self._by_sender = []
+        #newest timestamp per sender number
+        self._sender_last = []
+        #every entry number in timestamp order, or None while entries were appended in order
+        self._order = None
+        self._count = 0
+        self._last_time = float('-inf')
+        self._data_map = None
+        self._index_map = None
+        self._dirty = False
+        self._data = open(path, 'a+b')
+        self._index = open(self.index_path, 'a+b')
+        try:
+            self._recover()
+        except BaseException:
+            self._data.close()
+            self._index.close()
+            raise
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def __len__(self) -> int:
+        return self._count
+
+
+    def close(self) -> None:
+        """
+        Writes out anything buffered and closes both files.
+        """
+        if self._data.closed:
+            return
+        self.flush()
+        self._unmap()
+        self._data.close()
+        self._index.close()
+
+
+    def append(self, dm) -> None:
+        """
+        Adds one message to the end of the archive.
+
+        :param dm: DirectMessage (or any object with the same getters)
+        """
+        self.extend((dm,))
+
+
+    def extend(self, messages) -> int:
+        """
+        Adds messages to the end of the archive, in the order given.
+
+        Nothing is deduplicated: the archive is a log of what it was given.
+
+        :param messages: iterable of DirectMessage objects (e.g. DirectMessenger.iter_all())
+        :return: number of messages added
+        :rtype: int
+        """
+        added = 0
+        try:
+            for dm in messages:
+                sender = dm.get_recipient() or ''
+                body = (dm.get_message() or '').encode('utf-8')
+                ts = to_timestamp(dm.get_time())
+                name = sender.encode('utf-8')
+                if len(name) > 0xffff:
+                    raise ValueError("sender name is too long for the archive")
+                offset = self._size
+                self._data.write(_RECORD.pack(ts, len(name), len(body)))
+                self._data.write(name)
+                self._data.write(body)
+                self._size += _RECORD.size + len(name) + len(body)
+                sender_id = self._sender_id(sender)
+                self._index.write(_ENTRY.pack(offset, ts, sender_id))
+                self._dirty = True
+                self._add_entry(self._count, ts, sender_id)
+                added += 1
+        finally:
+            self.flush()
+        return added
+
+
+    def flush(self) -> None:
+        """
+        Writes buffered records to disk (data before index, so the index never points
+        past the data).
+        """
+        if not self._dirty:
+            return
+        self._data.flush()
+        if self.fsync:
+            os.fsync(self._data.fileno())
+        self._index.flush()
+        if self.fsync:
+            os.fsync(self._index.fileno())
+        self._dirty = False
+
+
+    def conversation(self, user:str, start:float = None, end:float = None) -> list:
+        """
+        Returns the messages from user, oldest first, optionally only those with
+        start <= timestamp < end.
+
+        :param user: correspondent
+        :param start: earliest timestamp (None: from the beginning)
+        :param end: timestamp to stop before (None: to the end)
+        :type user: str
+        :type start: float
+        :type end: float
+        :return: list of DirectMessage objects (empty if user is unknown)
+        :rtype: list
+        """
+        sender_id = self._name_ids.get(user)
+        if sender_id is None:
+            return []
+        self._map()
+        entries = self._by_sender[sender_id]
+        lo, hi = self._bounds(entries, len(entries), start, end)
+        return [self._read(entries[i]) for i in range(lo, hi)]
+
+
+    def scan(self, start:float = None, end:float = None):
+        """
+        Yields every message with start <= timestamp < end, oldest first, decoding
+        one record at a time.
+
+        :param start: earliest timestamp (None: from the beginning)
+        :param end: timestamp to stop before (None: to the end)
+        :type start: float
+        :type end: float
+        """
+        self._map()
+        order = self._order
+        lo, hi = self._bounds(order, self._count, start, end)
+        for i in range(lo, hi):
+            yield self._read(i if order is None else order[i])
+
+
+    def senders(self) -> list:
+        """
+        Returns every correspondent in the order they were first archived.
+
+        :rtype: list
+        """
+        return list(self._names)
+
+
+    def _sender_id(self, sender:str) -> int:
+        sender_id = self._name_ids.get(sender)
+        if sender_id is None:
+            sender_id = self._name_ids[sender] = len(self._names)
+            self._names.append(sender)
+            self._by_sender.append(array('I'))
+            self._sender_last.append(float('-inf'))
+        return sender_id
+
+
+    def _add_entry(self, i:int, ts:float, sender_id:int) -> None:
+        #files the new entry i under its sender and in the global time order; appends in
+        #timestamp order (the usual case) never have to look anything up on disk
+        entries = self._by_sender[sender_id]
+        if ts >= self._sender_last[sender_id]:
+            entries.append(i)
+            self._sender_last[sender_id] = ts
+        else:
+            entries.insert(self._bisect(entries, len(entries), ts, True), i)
+        if ts < self._last_time and self._order is None:
+            #the first entry out of order: from now on the order is kept explicitly
+            self._order = array('I', range(i))
+        if self._order is not None:
+            if ts >= self._last_time:
+                self._order.append(i)
+            else:
+                self._order.insert(self._bisect(self._order, len(self._order), ts, True), i)
+        self._last_time = max(self._last_time, ts)
+        self._count = i + 1
+
+
+    def _bounds(self, entries, n:int, start:float, end:float) -> tuple:
+        #positions in entries (None: entry numbers 0..n-1) of the range start <= ts < end
+        lo = 0 if start is None else self._bisect(entries, n, start, False)
+        hi = n if end is None else self._bisect(entries, n, end, False)
+        return lo, max(lo, hi)
+
+
+    def _bisect(self, entries, n:int, ts:float, right:bool) -> int:
+        self._map()
+        index = self._index_map
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = mid if entries is None else entries[mid]
+            t = _ENTRY.unpack_from(index, i * _ENTRY.size)[1]
+            if t < ts or (right and t == ts):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+    def _read(self, i:int) -> DirectMessage:
+        offset = _ENTRY.unpack_from(self._index_map, i * _ENTRY.size)[0]
+        data = self._data_map
+        ts, name_len, body_len = _RECORD.unpack_from(data, offset)
+        start = offset + _RECORD.size
+        sender = data[start:start + name_len].decode('utf-8')
+        body = data[start + name_len:start + name_len + body_len].decode('utf-8')
+        return DirectMessage(sender, body, ts)
+
+
+    def _map(self) -> None:
+        #(re)maps both files when they grew since the last mapping
+        self.flush()
+        index_size = self._count * _ENTRY.size
+        if self._index_map is not None and len(self._index_map) >= index_size:
+            return
+        self._unmap()
+        if index_size:
+            self._index_map = mmap.mmap(self._index.fileno(), index_size, access=mmap.ACCESS_READ)
+            self._data_map = mmap.mmap(self._data.fileno(), self._size, access=mmap.ACCESS_READ)
+
+
+    def _unmap(self) -> None:
+        if self._index_map is not None:
+            self._index_map.close()
+            self._data_map.close()
+            self._index_map = self._data_map = None
+
+
+    def _recover(self) -> None:
+        #checks both files, repairs them after a crash and loads the in-memory index
+        self._data.seek(0)
+        head = self._data.read(len(MAGIC))
+        if not head:
+            self._data.write(MAGIC)
+            self._data.flush()
+            self._index.truncate(0)
+            self._size = len(MAGIC)
+            return
+        if head != MAGIC:
+            raise ValueError(self.path + " is not a message archive")
+        data_size = os.path.getsize(self.path)
+        count = os.path.getsize(self.index_path) // _ENTRY.size
+        data = mmap.mmap(self._data.fileno(), data_size, access=mmap.ACCESS_READ)
+        index = mmap.mmap(self._index.fileno(), count * _ENTRY.size, access=mmap.ACCESS_READ) if count else None
+        missing = []
+        try:
+            #the data file is written first, so index entries past its end are dropped
+            end = None
+            while count:
+                end = _record_end(data, _ENTRY.unpack_from(index, (count - 1) * _ENTRY.size)[0], data_size)
+                if end is not None:
+                    break
+                count -= 1
+            if end is None:
+                end = len(MAGIC)
+            if count:
+                self._load(index, data, count)
+            #records written after the last index entry (the index append was lost)
+            next_end = _record_end(data, end, data_size)
+            while next_end is not None:
+                ts, name_len, _ = _RECORD.unpack_from(data, end)
+                start = end + _RECORD.size
+                missing.append((end, ts, data[start:start + name_len].decode('utf-8')))
+                end, next_end = next_end, _record_end(data, next_end, data_size)
+        finally:
+            if index is not None:
+                index.close()
+            data.close()
+        self._index.truncate(count * _ENTRY.size)
+        if end < data_size:
+            #the last record was cut short by a crash
+            self._data.truncate(end)
+        self._size = end
+        for offset, ts, sender in missing:
+            sender_id = self._sender_id(sender)
+            self._index.write(_ENTRY.pack(offset, ts, sender_id))
+            self._dirty = True
+            self._add_entry(self._count, ts, sender_id)
+        self.flush()
+
+
+    def _load(self, index:mmap.mmap, data:mmap.mmap, count:int) -> None:
+        #builds the per-sender lists and the time order from the first count index entries
+        times = array('d')
+        with memoryview(index) as view:
+            for i, (offset, ts, sender_id) in enumerate(struct.iter_unpack(_ENTRY.format,
+                                                                           view[:count * _ENTRY.size])):
+                if sender_id == len(self._names):
+                    #a sender is numbered when its first record is archived
+                    name_len = _RECORD.unpack_from(data, offset)[1]
+                    start = offset + _RECORD.size
+                    self._sender_id(data[start:start + name_len].decode('utf-8'))
+                elif sender_id > len(self._names):
+                    raise ValueError(self.index_path + " does not match " + self.path)
+                times.append(ts)
+                self._by_sender[sender_id].append(i)
+        for sender_id, entries in enumerate(self._by_sender):
+            if not _ascending(entries, times):
+                self._by_sender[sender_id] = array('I', sorted(entries, key=times.__getitem__))
+            self._sender_last[sender_id] = max(times[i] for i in entries)
+        if not _ascending(range(count), times):
+            self._order = array('I', sorted(range(count), key=times.__getitem__))
+        self._last_time = max(times)
+        self._count = count
+
+
+def _record_end(data:mmap.mmap, offset:int, size:int) -> int:
+    #end offset of the record at offset, or None if it does not fit in the first size bytes
+    if offset + _RECORD.size > size:
+        return None
+    _, name_len, body_len = _RECORD.unpack_from(data, offset)
+    end = offset + _RECORD.size + name_len + body_len
+    return end if end <= size else None
+
+
+def _ascending(entries, times:array) -> bool:
+    previous = float('-inf')
+    for i in entries:
+        if times[i] < previous:
+            return False
+        previous = times[i]
+    return True
@@ -0,0 +1,305 @@
+# ds_async.py
+#
+# asyncio version of the DirectMessenger client
+#
+# Speaks the same newline-delimited json protocol as ds_messenger.DirectMessenger,
+# but several requests can be in flight on one stream at the same time. The DS server
+# answers the requests on a connection in the order they were written, so responses
+# are matched to requests with a simple FIFO of pending futures.
+
+import asyncio
+import json
+import time
+from collections import deque
+
+from ds_messenger import DirectMessage, DSUProtocolError, DSUConnectionError
+from ds_limiter import LIMITER
+from ds_log import LOG
+
+#largest response line accepted; "all" responses carry the whole inbox on one line
+MAX_LINE = 64 * 1024 * 1024
+
+
+class AsyncDirectMessenger:
+    """
+    The AsyncDirectMessenger class is the asyncio counterpart of DirectMessenger.
+
+    One instance holds one connection and one token. Every coroutine (send, retrieve_new,
+    retrieve_all) writes its request straight away and waits for its own response, so
+    gathering many of them pipelines the requests on the single stream instead of waiting
+    for a round trip each. Many instances can share one event loop, e.g. one per account.
+    """
+    def __init__(self, dsuserver=None, username=None, password=None, port=3021):
+        """
+        Constructs all the necessary attributes for the AsyncDirectMessenger object.
+
+        :param dsuserver: server to connect to (defaults to the ICS 32 DS server)
+        :param username: username to connect with DS server
+        :param password: password for the username
+        :param port: port the DS server is listening on
+        :type dsuserver: str
+        :type username: str
+        :type password: str
+        :type port: int
+        """
+        self.dsuserver = dsuserver or '168.235.86.101'
+        self.port = port
+        self.username = username
+        self.password = password
+        self.token = None
+        self.resp_msg = None
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._connect_task = None
+        self._join_task = None
+        #futures waiting for a response, in the order their requests were written
+        self._pending = deque()
+
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+    async def connect(self) -> None:
+        """
+        Opens the stream to the DS server and starts the task that reads responses.
+
+        :raises DSUConnectionError: the server could not be reached
+        """
+        if self._writer is not None:
+            return
+        if self._connect_task is None:
+            #concurrent callers wait for the same stream instead of each opening one
+            self._connect_task = asyncio.ensure_future(asyncio.open_connection(self.dsuserver, self.port,
+                                                                               limit=MAX_LINE))
+        task = self._connect_task
+        try:
+            reader, writer = await asyncio.shield(task)
+        except OSError:
+            raise DSUConnectionError("an error occurred while connecting")
+        finally:
+            if task.done() and self._connect_task is task:
+                self._connect_task = None
+        if self._writer is None:
+            self._reader, self._writer = reader, writer
+            self._read_task = asyncio.create_task(self._read_responses())
+
+
+    async def close(self) -> None:
+        """
+        Closes the stream. Requests still waiting for a response fail with DSUConnectionError.
+        """
+        writer = self._writer
+        self._writer = None
+        self.token = None
+        self._join_task = None
+        if self._read_task is not None:
+            self._read_task.cancel()
+            try:
+                await self._read_task
+            except asyncio.CancelledError:
+                pass
+            self._read_task = None
+        self._fail_pending(DSUConnectionError("the connection was closed"))
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+    async def join(self) -> None:
+        """
+        Sends a join message and stores the token. Concurrent callers share one join.
+
+        :raises DSUProtocolError: the server rejected the join
+        """
+        await self.connect()
+        if self._join_task is None:
+            self._join_task = asyncio.ensure_future(self._join())
+        try:
+            await asyncio.shield(self._join_task)
+        except BaseException:
+            #let the next caller try again instead of reusing the failed join
+            if self._join_task is not None and self._join_task.done():
+                self._join_task = None
+            raise
+
+
+    async def _join(self) -> None:
+        x = {
+            "join": {
+                "username": self.username,
+                "password": self.password,
+                "token": ""
+                }
+            }
+        resp = await self._request(x)
+        self.token = resp["response"]["token"]
+
+
+    async def send(self, message:str, recipient:str) -> bool:
+        """
+        Sends a DirectMessage to the DS server.
+
+        :param message: message wanting to be sent
+        :param recipient: person you are sending the message to
+        :type message: str
+        :type recipient: str
+        :return: true if message successfully sent, false if the server rejected it
+        :rtype: bool
+        :raises DSUConnectionError: the connection broke
+        """
+        await self.join()
+        x = {
+            "token": self.token,
+            "directmessage": {
+                "entry": message,
+                "recipient": recipient,
+                "timestamp": time.time()
+                }
+            }
+        try:
+            await self._request(x)
+        except DSUConnectionError:
+            raise
+        except DSUProtocolError:
+            return False
+        return True
+
+
+    async def retrieve_new(self) -> list:
+        """
+        Retrieves the new messages from the DS Server as DirectMessage objects.
+
+        :return: list of DirectMessage objects
+        :rtype: list
+        :raises DSUProtocolError: the server rejected the request
+        """
+        return await self._retrieve("new")
+
+
+    async def retrieve_all(self) -> list:
+        """
+        Retrieves all the messages from the DS Server as DirectMessage objects.
+
+        :return: list of DirectMessage objects
+        :rtype: list
+        :raises DSUProtocolError: the server rejected the request
+        """
+        return await self._retrieve("all")
+
+
+    async def _retrieve(self, kind:str) -> list:
+        await self.join()
+        resp = await self._request({"token": self.token, "directmessage": kind})
+        return [DirectMessage(msgs["from"], msgs["message"], msgs["timestamp"])
+                for msgs in resp["response"]["messages"]]
+
+
+    async def _request(self, x:dict) -> dict:
+        """
+        Writes one request and waits for the response that belongs to it (after waiting
+        for the shared rate limiter, when it is on).
+
+        :param x: json body of the request
+        :type x: dict
+        :raises DSUConnectionError: the connection broke before the response arrived
+        :raises DSUProtocolError: the server answered with an error
+        :return: dictionary conversion of json message response
+        :rtype: dict
+        """
+        if not LIMITER.enabled:
+            return await self._request_once(x)
+        await LIMITER.acquire_async()
+        ok = False
+        try:
+            resp = await self._request_once(x)
+            ok = True
+            return resp
+        except asyncio.CancelledError:
+            ok = None
+            raise
+        finally:
+            LIMITER.release(ok)
+
+
+    async def _request_once(self, x:dict) -> dict:
+        if self._writer is None:
+            raise DSUConnectionError("not connected")
+        fut = asyncio.get_running_loop().create_future()
+        #the future is queued before the write so the reader can never see a response first
+        self._pending.append(fut)
+        try:
+            line = json.dumps(x) + '\n'
+            self._writer.write(line.encode('utf-8'))
+            if LOG.recording:
+                LOG.record('send', line)
+            await self._writer.drain()
+        except (OSError, RuntimeError):
+            #nothing will answer this request, so the next response must not be matched to it
+            try:
+                self._pending.remove(fut)
+            except ValueError:
+                pass
+            raise DSUConnectionError("an error occurred while connecting")
+        resp = await fut
+        self.resp_msg = resp
+        if resp["response"]["type"] == 'error':
+            raise DSUProtocolError(resp["response"].get("message", "an error occurred"))
+        return resp
+
+
+    async def _read_responses(self) -> None:
+        """
+        Reads response lines for as long as the stream is open and hands each one to
+        the oldest pending request.
+        """
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                if LOG.recording:
+                    LOG.record('recv', line)
+                try:
+                    resp = json.loads(line)
+                    resp["response"]["type"]
+                except (ValueError, KeyError, TypeError):
+                    self._fail_one(DSUProtocolError("an error occurred while connecting"))
+                    continue
+                if self._pending:
+                    #a cancelled request still owns its response, so it is dropped here
+                    fut = self._pending.popleft()
+                    if not fut.done():
+                        fut.set_result(resp)
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        #the stream is unusable from here on; the next call to connect opens a new one
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._fail_pending(DSUConnectionError("the server closed the connection"))
+        self.token = None
+        self._join_task = None
+
+
+    def _fail_one(self, exc:Exception) -> None:
+        if self._pending:
+            fut = self._pending.popleft()
+            if not fut.done():
+                fut.set_exception(exc)
+
+
+    def _fail_pending(self, exc:Exception) -> None:
+        while self._pending:
+            fut = self._pending.popleft()
+            if not fut.done():
+                fut.set_exception(exc)
@@ -0,0 +1,211 @@
+# ds_bench.py
+#
+# Benchmarks for the DS messenger clients
+#
+# Every case runs against a local ds_server emulator on the loopback interface and
+# reports p50/p95/p99 latency and operations per second. Results are written as json
+# so two runs (e.g. before and after a change) can be compared:
+#
+#     python ds_bench.py --sizes 1000,100000 --out before.json
+#     python ds_bench.py --sizes 1000,100000 --out after.json
+#     python ds_bench.py --compare before.json after.json
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import ds_client
+from ds_messenger import DirectMessenger
+from ds_server import ServerThread
+
+#the account whose history is seeded and retrieved
+READER = 'bench_reader'
+WRITER = 'bench_writer'
+#sends go here, so the reader's inbox stays at the seeded size whatever ran before
+SINK = 'bench_sink'
+PASSWORD = 'bench'
+
+
+def _operations(host:str, port:int, payload:str) -> dict:
+    """
+    Builds the benchmarked operations. Each one is a function doing one call.
+    """
+    one_shot = DirectMessenger(host, WRITER, PASSWORD, port=port)
+    session = DirectMessenger(host, WRITER, PASSWORD, keep_alive=True, port=port)
+    reader = DirectMessenger(host, READER, PASSWORD, port=port)
+    post = repr({'entry': payload, 'timestamp': str(time.time())})
+    return {
+        'send': lambda: one_shot.send(payload, SINK),
+        'send_keep_alive': lambda: session.send(payload, SINK),
+        'retrieve_new': reader.retrieve_new,
+        'retrieve_all': reader.retrieve_all,
+        'iter_all': lambda: sum(1 for _ in reader.iter_all()),
+        'ds_client.send': lambda: ds_client.send(host, port, WRITER, PASSWORD, post, 'bench bio'),
+        }
+
+
+def _setups(server) -> dict:
+    """
+    Builds the untimed preparation run before every sample of an operation.
+    """
+    def unread():
+        #seed leaves nothing unread, so every sample gets the seeded history as new messages
+        server.unread[READER] = list(server.inboxes.get(READER, []))
+    return {'retrieve_new': unread}
+
+
+def measure(func, iterations:int, budget:float, setup=None) -> list:
+    """
+    Runs func until it has run iterations times or budget seconds have passed
+    (but at least three times), and returns the latency of every run in seconds.
+
+    :param func: operation to time
+    :param iterations: most runs
+    :param budget: most seconds to spend
+    :param setup: called before every run, outside the timing (optional)
+    :type func: function
+    :type iterations: int
+    :type budget: float
+    :type setup: function
+    :rtype: list
+    """
+    samples = []
+    deadline = time.perf_counter() + budget
+    while len(samples) < iterations and (len(samples) < 3 or time.perf_counter() < deadline):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(samples:list) -> dict:
+    """
+    Turns latency samples into percentiles (milliseconds) and throughput.
+
+    :param samples: latencies in seconds
+    :type samples: list
+    :rtype: dict
+    """
+    if len(samples) > 1:
+        cuts = statistics.quantiles(samples, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = samples[0]
+    total = sum(samples)
+    return {
+        'n': len(samples),
+        'p50_ms': round(p50 * 1000, 4),
+        'p95_ms': round(p95 * 1000, 4),
+        'p99_ms': round(p99 * 1000, 4),
+        'mean_ms': round(total / len(samples) * 1000, 4),
+        'ops_per_sec': round(len(samples) / total, 2) if total else None,
+        }
+
+
+def run(sizes:list, payloads:list, ops:list, iterations:int, budget:float, latency:float) -> list:
+    """
+    Runs every operation for every history size and payload size.
+
+    :return: list of result dicts
+    :rtype: list
+    """
+    results = []
+    for size in sizes:
+        for payload_size in payloads:
+            with ServerThread(latency=latency) as srv:
+                srv.server.seed(READER, size, size=payload_size)
+                payload = 'x' * payload_size
+                operations = _operations(srv.host, srv.port, payload)
+                setups = _setups(srv.server)
+                for op in ops:
+                    samples = measure(operations[op], iterations, budget, setups.get(op))
+                    result = {'op': op, 'history': size, 'payload': payload_size}
+                    result.update(summarize(samples))
+                    results.append(result)
+                    print('%-16s history=%-8d payload=%-6d p50=%9.3fms p95=%9.3fms p99=%9.3fms %10.1f ops/s'
+                          % (op, size, payload_size, result['p50_ms'], result['p95_ms'],
+                             result['p99_ms'], result['ops_per_sec'] or 0))
+    return results
+
+
+def _git_revision() -> str:
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(old_path:str, new_path:str) -> None:
+    """
+    Prints the change in p50 latency and throughput between two result files.
+    """
+    with open(old_path) as f:
+        old = {(r['op'], r['history'], r['payload']): r for r in json.load(f)['results']}
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    for r in new:
+        before = old.get((r['op'], r['history'], r['payload']))
+        if before is None:
+            continue
+        print('%-16s history=%-8d payload=%-6d p50 %9.3f -> %9.3fms (x%.2f)  ops/s %10.1f -> %10.1f'
+              % (r['op'], r['history'], r['payload'], before['p50_ms'], r['p50_ms'],
+                 r['p50_ms'] / before['p50_ms'] if before['p50_ms'] else float('nan'),
+                 before['ops_per_sec'] or 0, r['ops_per_sec'] or 0))
+
+
+def _int_list(text:str) -> list:
+    return [int(x) for x in text.split(',') if x]
+
+
+def main(argv=None) -> None:
+    ops = ['send', 'send_keep_alive', 'retrieve_new', 'retrieve_all', 'iter_all', 'ds_client.send']
+    parser = argparse.ArgumentParser(description="Benchmark the DS messenger clients against a local server")
+    parser.add_argument('--sizes', type=_int_list, default=[1000, 100000, 1000000],
+                        help="comma separated history sizes (messages)")
+    parser.add_argument('--payloads', type=_int_list, default=[32, 1024],
+                        help="comma separated message sizes (characters)")
+    parser.add_argument('--ops', default=','.join(ops), help="comma separated operations: " + ', '.join(ops))
+    parser.add_argument('--iterations', type=int, default=200, help="most runs per case")
+    parser.add_argument('--budget', type=float, default=2.0, help="most seconds per case (at least 3 runs)")
+    parser.add_argument('--latency', type=float, default=0.0, help="server latency per response in ms")
+    parser.add_argument('--label', default=None, help="free text stored with the results")
+    parser.add_argument('--out', default=None, help="write results as json to this file")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    selected = [op for op in args.ops.split(',') if op]
+    unknown = [op for op in selected if op not in ops]
+    if unknown:
+        parser.error("unknown operations: " + ', '.join(unknown))
+
+    results = run(args.sizes, args.payloads, selected, args.iterations, args.budget, args.latency / 1000)
+    if args.out:
+        report = {
+            'meta': {
+                'label': args.label,
+                'revision': _git_revision(),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'latency_ms': args.latency,
+                },
+            'results': results,
+            }
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,13 @@
+import argparse
+import getpass
+import json
+import os
+import sys
+import time
+from collections import deque
+
 import ds_protocol
+from ds_limiter import LIMITER
 
 '''
  The send function joins a ds server and sends a message, bio, or both
@@ -9,29 +18,232 @@ import ds_protocol
  :param password: The password associated with the username.
  :param message: The message to be sent to the server.
  :param bio: Optional, a bio for the user.
+ :param token_cache: Optional, a ds_tokens.TokenCache; a cached token is used instead of
+                     joining, and the server is joined again only if it rejects the token.
  '''
 
 
-def send(server: str, port: int, username: str, password: str, message: str, bio: str = None):
+def send(server: str, port: int, username: str, password: str, message: str, bio: str = None,
+         token_cache=None):
     client = ds_protocol.connect_server(server, port)
-    response = ds_protocol.join(client, username, password)
+    response = None
+    if token_cache is not None:
+        response = token_cache.get(server, port, username)
+    cached = response is not None
+    if not cached:
+        response = _join(client, server, port, username, password, token_cache)
     if response != "error":
-        ds_protocol.post(client, response, message)
-        ds_protocol.bio(client, response, bio)
+        result = ds_protocol.post(client, response, message)
+        if result == "error" and cached:
+            #the cached token is out of date
+            response = _join(client, server, port, username, password, token_cache)
+            if response == "error":
+                return
+            ds_protocol.post(client, response, message)
+        if bio is not None:
+            ds_protocol.bio(client, response, bio)
     pass
 
 
-def verify(server: str, port: int, username: str, password: str):
+def verify(server: str, port: int, username: str, password: str, token_cache=None):
+    #the cache does not know the password, so checking one always takes a join
     client = ds_protocol.connect_server(server, port)
-    response = ds_protocol.join(client, username, password)
+    response = _join(client, server, port, username, password, token_cache)
     if response == "error":
         return True
     return False
 
 
+def _join(client, server: str, port: int, username: str, password: str, token_cache):
+    response = ds_protocol.join(client, username, password)
+    if token_cache is not None:
+        if response == "error":
+            token_cache.forget(server, port, username)
+        else:
+            token_cache.put(server, port, username, response)
+    return response
+
+
+def send_records(server: str, port: int, username: str, password: str, records, window: int = 64):
+    '''
+    Publishes a stream of posts and bios over one connection with a single join.
+
+    Each record is a dict (or a json line) holding a post, a bio or both:
+    {"entry": ..., "timestamp": ...} or {"post": ...} is a post, {"bio": ...} is a bio.
+    Requests are written back to back with up to window of them waiting for a response,
+    and records are read from the iterable only as the window frees up, so memory stays
+    constant however long the stream is.
+
+    Yields one result dict per request, in input order:
+    {"record": n, "kind": "post"|"bio", "type": "ok"|"error", "message": ...}. A failed
+    join yields a single result with kind "join". If the connection breaks, the requests
+    that were waiting are reported as errors and nothing more is read.
+    '''
+    client = ds_protocol.connect_server(server, port)
+    #(record number, kind, result already known) for every request without an answer yet
+    pending = deque()
+    limited = LIMITER.enabled
+    try:
+        resp = ds_protocol.send_request(client, {"join": {"username": username, "password": password, "token": ""}})
+        kind = ds_protocol.response_type(resp)
+        if kind != "ok":
+            message = resp["response"].get("message") if kind is not None else None
+            yield _result(None, "join", "error", message or "could not join")
+            return
+        token = resp["response"].get("token")
+        writer = ds_protocol.LineWriter(client)
+        reader = ds_protocol.reader_for(client)
+        #requests not written yet
+        unsent = []
+        window = max(1, window)
+        for n, record in enumerate(records, 1):
+            if isinstance(record, (str, bytes)) and not record.strip():
+                #blank lines are skipped but counted, so n stays the line number
+                continue
+            try:
+                requests = _requests_for(record, token)
+            except ValueError as e:
+                pending.append((n, "record", _result(n, "record", "error", str(e))))
+                requests = []
+            for kind, body in requests:
+                while limited and not LIMITER.acquire(timeout=0):
+                    if all(known is not None for _, _, known in pending):
+                        #nothing of ours is in flight, so just wait for the limiter
+                        LIMITER.acquire()
+                        break
+                    #collect our own responses while the limiter says wait
+                    if unsent:
+                        writer.write_many(unsent)
+                        unsent = []
+                    result = _next_result(pending, reader, limited)
+                    if result is None:
+                        yield from _lost(pending, limited=limited)
+                        return
+                    yield result
+                unsent.append(body)
+                pending.append((n, kind, None))
+            while len(pending) >= window or (pending and pending[0][2] is not None):
+                if unsent:
+                    writer.write_many(unsent)
+                    unsent = []
+                result = _next_result(pending, reader, limited)
+                if result is None:
+                    yield from _lost(pending, limited=limited)
+                    return
+                yield result
+        if unsent:
+            writer.write_many(unsent)
+        while pending:
+            result = _next_result(pending, reader, limited)
+            if result is None:
+                yield from _lost(pending, limited=limited)
+                return
+            yield result
+    except OSError as e:
+        yield from _lost(pending, str(e), limited)
+    finally:
+        if limited:
+            #the caller stopped early; frees the slots of requests still in flight
+            for _, _, known in pending:
+                if known is None:
+                    LIMITER.release(None)
+        client.close()
+
+
+def _requests_for(record, token: str) -> list:
+    if isinstance(record, (str, bytes)):
+        try:
+            record = json.loads(record)
+        except ValueError:
+            raise ValueError("not valid json")
+    if not isinstance(record, dict):
+        raise ValueError("record is not a json object")
+    requests = []
+    if "post" in record or "entry" in record:
+        post = record.get("post", record)
+        if isinstance(post, dict) and post.get("timestamp") is None:
+            post = dict(post, timestamp=time.time())
+        requests.append(("post", {"token": token, "post": ds_protocol.to_entry(post)}))
+    if record.get("bio") is not None:
+        bio = record["bio"]
+        if isinstance(bio, dict):
+            entry = {"entry": str(bio.get("entry")), "timestamp": str(bio.get("timestamp", time.time()))}
+        else:
+            entry = {"entry": str(bio), "timestamp": str(time.time())}
+        requests.append(("bio", {"token": token, "bio": entry}))
+    if not requests:
+        raise ValueError("record has no post or bio")
+    return requests
+
+
+def _next_result(pending: deque, reader, limited: bool = False):
+    '''
+    Returns the result of the oldest pending request, reading its response if it was
+    sent, or None once the connection is gone.
+    '''
+    n, kind, known = pending[0]
+    if known is not None:
+        pending.popleft()
+        return known
+    line = reader.readline()
+    if not line:
+        return None
+    pending.popleft()
+    try:
+        resp = json.loads(line)["response"]
+        result = _result(n, kind, resp.get("type"), resp.get("message"))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        result = _result(n, kind, "error", "Json cannot be decoded.")
+    if limited:
+        LIMITER.release(result["type"] == "ok")
+    return result
+
+
+def _lost(pending: deque, message: str = "connection lost", limited: bool = False):
+    while pending:
+        n, kind, known = pending.popleft()
+        if known is None and limited:
+            LIMITER.release(False)
+        yield known if known is not None else _result(n, kind, "error", message)
+
+
+def _result(n, kind: str, type: str, message: str) -> dict:
+    return {"record": n, "kind": kind, "type": type, "message": message}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Publish posts and bios from a JSONL stream to a DS server. "
+                                                 "One result per request is printed as JSONL.")
+    parser.add_argument('file', nargs='?', default='-', help="JSONL records (default: stdin)")
+    parser.add_argument('--server', default='168.235.86.101')
+    parser.add_argument('--port', type=int, default=3021)
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', default=os.environ.get('DS_PASSWORD'),
+                        help="defaults to $DS_PASSWORD, otherwise it is asked for")
+    parser.add_argument('--window', type=int, default=64, help="most requests waiting for a response")
+    args = parser.parse_args(argv)
+    password = args.password if args.password is not None else getpass.getpass()
+
+    source = sys.stdin if args.file == '-' else open(args.file, encoding='utf-8')
+    failed = 0
+    try:
+        for result in send_records(args.server, args.port, args.username, password, source, args.window):
+            if result["type"] != "ok":
+                failed += 1
+            sys.stdout.write(json.dumps(result) + '\n')
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    return 1 if failed else 0
+
+
 # send("168.235.86.101", 2021, "Jun", "password123", "Hahaha", "I am Issac")
 def test():
     send("168.235.86.101", 2021, "Jun", "password123", "Hahaha", "I am Issac")
     print("create testing branch")
     print("merge to main")
     print("main branch")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,310 @@
+# ds_export.py
+#
+# Streaming export and import of direct message history
+#
+# Messages are written to and read from JSONL (one {"from", "message", "timestamp"}
+# object per line, the shape the DS server uses) or CSV (a from,message,timestamp header
+# and one row per message), gzip compressed when the file name ends in .gz. Both ways
+# stream: the history is pulled from DirectMessenger.iter_all (or a local store or
+# archive) one message at a time and written out in chunks, and an import hands the
+# messages to the store or archive in chunks, so memory use does not grow with the size
+# of the history.
+#
+#     python ds_export.py export inbox.jsonl.gz --username me --with friend --since 2024-01-01
+#     python ds_export.py import inbox.jsonl.gz --store ds_messages.db --account me
+#     python ds_export.py export old.csv --archive history.dsa
+
+import argparse
+import contextlib
+import csv
+import datetime
+import getpass
+import gzip
+import io
+import json
+import os
+import sys
+
+from ds_messenger import DirectMessage, DirectMessenger, to_timestamp
+
+FIELDS = ('from', 'message', 'timestamp')
+#messages per write or per store/archive call
+CHUNK_SIZE = 5000
+
+
+def export_history(messenger, path:str, fmt:str = None, users=None, start:float = None, end:float = None,
+                   compress:bool = None) -> int:
+    """
+    Streams the whole history of messenger's account to a file.
+
+    :param messenger: DirectMessenger of the account to export
+    :param path: file to write ("-" writes to stdout)
+    :param fmt: "jsonl" or "csv" (None: taken from the file name, jsonl by default)
+    :param users: only export messages from these correspondents (None exports everyone)
+    :param start: only export messages with timestamp >= start
+    :param end: only export messages with timestamp < end
+    :param compress: gzip the file (None: if path ends in .gz)
+    :return: number of messages written
+    :rtype: int
+    :raises DSUProtocolError: the server could not be reached or answered with an error
+    """
+    return write_messages(messenger.iter_all(), path, fmt, users, start, end, compress)
+
+
+def import_history(path:str, target, fmt:str = None, users=None, start:float = None, end:float = None) -> int:
+    """
+    Streams messages from an export file into a local MessageStore or Archive.
+
+    :param path: file to read ("-" reads stdin); gzip is detected from its content
+    :param target: ds_store.MessageStore (duplicates are skipped) or ds_archive.Archive
+    :param fmt: "jsonl" or "csv" (None: taken from the file name, jsonl by default)
+    :param users: only import messages from these correspondents (None imports everyone)
+    :param start: only import messages with timestamp >= start
+    :param end: only import messages with timestamp < end
+    :return: number of messages the target took
+    :rtype: int
+    """
+    added = 0
+    chunk = []
+    for dm in read_messages(path, fmt, users, start, end):
+        chunk.append(dm)
+        if len(chunk) >= CHUNK_SIZE:
+            added += _store(target, chunk)
+            chunk = []
+    if chunk:
+        added += _store(target, chunk)
+    return added
+
+
+def write_messages(messages, path:str, fmt:str = None, users=None, start:float = None, end:float = None,
+                   compress:bool = None) -> int:
+    """
+    Writes messages to a JSONL or CSV file, chunk by chunk.
+
+    :param messages: iterable of DirectMessage objects
+    :return: number of messages written
+    :rtype: int
+    """
+    fmt = _format(path, fmt)
+    keep = _filter(users, start, end)
+    written = 0
+    with _open(path, 'w', compress) as f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer is not None:
+            writer.writerow(FIELDS)
+        chunk = []
+        for dm in messages:
+            if not keep(dm):
+                continue
+            if writer is not None:
+                chunk.append((dm.get_recipient(), dm.get_message(), dm.get_time()))
+            else:
+                chunk.append(json.dumps({'from': dm.get_recipient(), 'message': dm.get_message(),
+                                         'timestamp': dm.get_time()}) + '\n')
+            if len(chunk) >= CHUNK_SIZE:
+                written += _write_chunk(f, writer, chunk)
+                chunk = []
+        written += _write_chunk(f, writer, chunk)
+    return written
+
+
+def read_messages(path:str, fmt:str = None, users=None, start:float = None, end:float = None):
+    """
+    Yields the messages of a JSONL or CSV export file one at a time.
+
+    :param path: file to read ("-" reads stdin); gzip is detected from its content
+    :raises ValueError: a line or row is not a message (its line number is in the message)
+    """
+    fmt = _format(path, fmt)
+    keep = _filter(users, start, end)
+    with _open(path, 'r') as f:
+        if fmt == 'csv':
+            rows = csv.DictReader(f)
+            for row in rows:
+                dm = _to_message(row, rows.line_num)
+                if keep(dm):
+                    yield dm
+        else:
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    raise ValueError("line %d is not valid json" % n)
+                dm = _to_message(record, n)
+                if keep(dm):
+                    yield dm
+
+
+def _to_message(record, n:int) -> DirectMessage:
+    try:
+        return DirectMessage(record['from'], record['message'], float(record['timestamp']))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("line %d is not a message" % n)
+
+
+def _write_chunk(f, writer, chunk:list) -> int:
+    if writer is not None:
+        writer.writerows(chunk)
+    else:
+        f.writelines(chunk)
+    return len(chunk)
+
+
+def _store(target, chunk:list) -> int:
+    #MessageStore.add returns the messages it kept, Archive.extend a count
+    if hasattr(target, 'extend'):
+        return target.extend(chunk)
+    return len(target.add(chunk))
+
+
+def _filter(users, start:float, end:float):
+    users = None if users is None else set(users)
+
+    def keep(dm) -> bool:
+        if users is not None and dm.get_recipient() not in users:
+            return False
+        if start is None and end is None:
+            return True
+        ts = to_timestamp(dm.get_time())
+        return (start is None or ts >= start) and (end is None or ts < end)
+    return keep
+
+
+def _format(path:str, fmt:str) -> str:
+    if fmt is None:
+        name = path[:-3] if path.endswith('.gz') else path
+        fmt = 'csv' if name.endswith('.csv') else 'jsonl'
+    if fmt not in ('jsonl', 'csv'):
+        raise ValueError("unknown format: " + fmt)
+    return fmt
+
+
+@contextlib.contextmanager
+def _open(path:str, mode:str, compress:bool = None):
+    #text stream for csv/json; gzip is chosen by name when writing and by content when reading
+    std = path == '-'
+    if std:
+        raw = sys.stdout.buffer if mode == 'w' else sys.stdin.buffer
+    else:
+        raw = open(path, mode + 'b')
+    try:
+        if mode == 'w':
+            gzipped = path.endswith('.gz') if compress is None else compress
+        else:
+            gzipped = raw.peek(2)[:2] == b'\x1f\x8b'
+        stream = gzip.GzipFile(fileobj=raw, mode=mode + 'b') if gzipped else raw
+        f = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        try:
+            yield f
+        finally:
+            #detach so stdin/stdout stay open; GzipFile.close writes the gzip trailer
+            f.flush()
+            f.detach()
+            if gzipped:
+                stream.close()
+    finally:
+        if std:
+            if mode == 'w':
+                raw.flush()
+        else:
+            raw.close()
+
+
+def _time(text:str) -> float:
+    #a unix timestamp or an ISO date/time (local time unless it names a zone)
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("not a timestamp or ISO date: " + text)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Export direct message history to JSONL/CSV, or import it "
+                                                 "into a local store or archive. Files ending in .gz are gzipped.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    export = sub.add_parser('export', help="write history to a file")
+    export.add_argument('file', help="output file (.jsonl, .csv, optionally .gz; - for stdout)")
+    export.add_argument('--server', default='168.235.86.101')
+    export.add_argument('--port', type=int, default=3021)
+    export.add_argument('--username', help="account to export from the server")
+    export.add_argument('--password', default=os.environ.get('DS_PASSWORD'),
+                        help="defaults to $DS_PASSWORD, otherwise it is asked for")
+    export.add_argument('--store', help="export from this local database instead of the server")
+    export.add_argument('--archive', help="export from this ds_archive file instead of the server")
+    export.add_argument('--account', help="account in --store (default: --username)")
+    export.add_argument('--gzip', action='store_true', default=None, help="compress even without .gz")
+    imp = sub.add_parser('import', help="read history from a file")
+    imp.add_argument('file', help="input file (.jsonl or .csv, gzipped or not; - for stdin)")
+    imp.add_argument('--store', help="local database to import into")
+    imp.add_argument('--archive', help="ds_archive file to import into")
+    imp.add_argument('--account', help="account the messages belong to (needed with --store)")
+    for command in (export, imp):
+        command.add_argument('--format', choices=('jsonl', 'csv'), default=None,
+                             help="default: from the file name, otherwise jsonl")
+        command.add_argument('--with', dest='users', action='append', default=None, metavar='USER',
+                             help="only messages from this correspondent (repeatable)")
+        command.add_argument('--since', type=_time, default=None, help="unix time or ISO date, inclusive")
+        command.add_argument('--until', type=_time, default=None, help="unix time or ISO date, exclusive")
+    args = parser.parse_args(argv)
+    filters = (args.format, args.users, args.since, args.until)
+
+    if args.command == 'export':
+        if args.archive and args.store:
+            parser.error("export takes --store or --archive, not both")
+        source = args.archive or args.store
+        if source and not os.path.exists(source):
+            #opening a missing archive or store would create an empty one
+            parser.error("no such file: " + source)
+        if args.store and not (args.account or args.username):
+            parser.error("export from --store needs --account (or --username)")
+        if args.archive:
+            from ds_archive import Archive
+            with Archive(args.archive) as archive:
+                count = write_messages(archive.scan(args.since, args.until), args.file, *filters, args.gzip)
+        elif args.store:
+            from ds_store import MessageStore
+            store = MessageStore(args.store, args.account or args.username)
+            try:
+                count = write_messages(store.iter_messages(args.since, args.until), args.file, *filters, args.gzip)
+            finally:
+                store.close()
+        else:
+            if not args.username:
+                parser.error("export needs --username (or --store / --archive)")
+            password = args.password if args.password is not None else getpass.getpass()
+            messenger = DirectMessenger(args.server, args.username, password, keep_alive=True, port=args.port)
+            try:
+                count = export_history(messenger, args.file, *filters, args.gzip)
+            finally:
+                messenger.close()
+        print("exported %d messages" % count, file=sys.stderr)
+    else:
+        if args.archive and args.store:
+            parser.error("import takes --store or --archive, not both")
+        if args.archive:
+            from ds_archive import Archive
+            with Archive(args.archive) as archive:
+                count = import_history(args.file, archive, *filters)
+        elif args.store:
+            if not args.account:
+                parser.error("import into --store needs --account")
+            from ds_store import MessageStore
+            store = MessageStore(args.store, args.account)
+            try:
+                count = import_history(args.file, store, *filters)
+            finally:
+                store.close()
+        else:
+            parser.error("import needs --store or --archive")
+        print("imported %d messages" % count, file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+# ds_limiter.py
+#
+# Client-side rate limiting and adaptive concurrency for DS server requests
+#
+# Every join, directmessage, post and bio request made by ds_protocol, ds_client,
+# DirectMessenger and AsyncDirectMessenger goes through LIMITER when it is enabled. A
+# request needs a token from a token bucket refilled at `rate` per second and one of
+# `limit` in-flight slots. Both adapt AIMD style: each successful response nudges them up
+# (the rate by about `increase` per second of full-speed traffic), and an error response,
+# a timeout or a broken connection cuts both by `decrease` (at most once per `cooldown`
+# seconds, so one burst of failures counts once). Clients then settle just below the
+# point where the server starts answering with errors.
+#
+# Off by default, like ds_metrics; every call site checks LIMITER.enabled first.
+#
+#     import ds_limiter
+#     ds_limiter.enable(rate=50, max_rate=500)
+#     ...
+#     print(ds_limiter.stats())
+#
+# DS_RATE_LIMIT=50 in the environment enables it with a starting rate of 50 per second.
+
+import os
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    The RateLimiter class is a token bucket plus an AIMD concurrency limit, shared by
+    every thread (and event loop) of the process.
+
+    Callers pair every acquire with one release(ok) once the response is in.
+    """
+    def __init__(self, rate:float = 20.0, burst:float = 10.0, min_rate:float = 1.0, max_rate:float = 1000.0,
+                 concurrency:float = 8.0, max_concurrency:float = 64.0, increase:float = 10.0,
+                 decrease:float = 0.5, cooldown:float = 0.5, retries:int = 2, enabled:bool = False):
+        """
+        Constructs all the necessary attributes for the RateLimiter object.
+
+        :param rate: starting requests per second
+        :param burst: most tokens the bucket holds (requests that can go out at once after a pause)
+        :param min_rate: the rate never drops below this
+        :param max_rate: the rate never grows above this
+        :param concurrency: starting limit on requests waiting for a response
+        :param max_concurrency: the concurrency limit never grows above this
+        :param increase: requests per second added for every second of successful full-speed traffic
+        :param decrease: factor applied to rate and concurrency after a failure
+        :param cooldown: seconds after a decrease during which further failures are not counted again
+        :param retries: how often DirectMessenger retries a request whose connection broke (only
+                        if it never reached the server or is safe to send twice)
+        :param enabled: start enabled
+        """
+        self.enabled = enabled
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.limit = float(concurrency)
+        self.max_concurrency = float(max_concurrency)
+        self.increase = float(increase)
+        self.decrease = float(decrease)
+        self.cooldown = float(cooldown)
+        self.retries = retries
+        self._cond = threading.Condition()
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._last_decrease = 0.0
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.decreases = 0
+        self.waited = 0.0
+
+
+    def acquire(self, timeout:float = None) -> bool:
+        """
+        Waits for a token and a free slot, then takes both.
+
+        :param timeout: most seconds to wait (None waits as long as it takes, 0 never waits)
+        :type timeout: float
+        :return: true if the request may go out, false if timeout ran out first
+        :rtype: bool
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self._cond:
+            while True:
+                wait = self._take()
+                if wait == 0:
+                    self.waited += time.monotonic() - start
+                    return True
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+
+
+    async def acquire_async(self) -> None:
+        """
+        acquire for coroutines: waits with asyncio.sleep instead of blocking the loop.
+        """
+        #imported here: only async callers need it, and it is slow to import for the GUI
+        import asyncio
+        start = time.monotonic()
+        while True:
+            with self._cond:
+                wait = self._take()
+            if wait == 0:
+                with self._cond:
+                    self.waited += time.monotonic() - start
+                return
+            #no slot free: check again shortly (slots are freed by other coroutines or threads)
+            await asyncio.sleep(0.005 if wait is None else wait)
+
+
+    def release(self, ok:bool = True) -> None:
+        """
+        Gives back the slot taken by acquire and adapts rate and concurrency.
+
+        :param ok: true if the server answered the request with "ok", None if the
+                   request was abandoned without an answer (the slot is freed, nothing adapts)
+        :type ok: bool
+        """
+        with self._cond:
+            self.in_flight = max(0, self.in_flight - 1)
+            if ok:
+                self.successes += 1
+                self.rate = min(self.max_rate, self.rate + self.increase / max(self.rate, 1.0))
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / max(self.limit, 1.0))
+            elif ok is not None:
+                self.failures += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self._last_decrease = now
+                    self.decreases += 1
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self.limit = max(1.0, self.limit * self.decrease)
+                    self._tokens = min(self._tokens, 1.0)
+            self._cond.notify_all()
+
+
+    def stats(self) -> dict:
+        """
+        Returns the current rate and concurrency limit and what happened so far.
+
+        :return: rate (requests per second), limit, in_flight, successes, failures,
+                 decreases and waited (total seconds callers spent waiting)
+        :rtype: dict
+        """
+        with self._cond:
+            return {
+                'enabled': self.enabled,
+                'rate': round(self.rate, 3),
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'successes': self.successes,
+                'failures': self.failures,
+                'decreases': self.decreases,
+                'waited': round(self.waited, 6),
+                }
+
+
+    def _take(self):
+        #takes a token and a slot and returns 0, or returns how long to wait for a
+        #token (None: until a slot is released); callers hold self._cond
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        if self.in_flight >= max(1, int(self.limit)):
+            return None
+        if self._tokens < 1.0:
+            return (1.0 - self._tokens) / self.rate
+        self._tokens -= 1.0
+        self.in_flight += 1
+        return 0
+
+
+LIMITER = RateLimiter()
+if os.environ.get('DS_RATE_LIMIT', '') not in ('', '0'):
+    LIMITER.rate = float(os.environ['DS_RATE_LIMIT'])
+    LIMITER.enabled = True
+
+
+def enable(**settings) -> None:
+    """
+    Turns LIMITER on, optionally changing its settings (rate, max_rate, limit, ...).
+    """
+    with LIMITER._cond:
+        for name, value in settings.items():
+            if not hasattr(LIMITER, name):
+                raise TypeError("unknown setting: " + name)
+            setattr(LIMITER, name, value)
+        LIMITER.enabled = True
+
+
+def disable() -> None:
+    LIMITER.enabled = False
+
+
+def stats() -> dict:
+    return LIMITER.stats()
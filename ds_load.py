@@ -0,0 +1,264 @@
+# ds_load.py
+#
+# Load generator for the DS messenger stack
+#
+# Simulates many chat users at once: the users are spread over a pool of processes
+# (threads inside each process), and every user loops over think time followed by one
+# operation picked from a weighted mix - a direct message to one of its fan-out
+# recipients, retrieve_new, retrieve_all, or a journal post through ds_protocol. The
+# latency of every operation is sent back to the parent, which prints one report with
+# throughput, error rates and p50/p95/p99 per operation.
+#
+#     python ds_load.py --users 200 --processes 4 --duration 30 --think 500
+#     python ds_load.py --users 50 --mix send=5,retrieve_new=4,post=1 --out load.json
+#
+# Without --server a local ds_server emulator is started in this process.
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import threading
+import time
+
+import ds_protocol
+from ds_bench import summarize
+from ds_messenger import DirectMessenger
+from ds_server import ServerThread
+
+PASSWORD = 'load'
+OPERATIONS = ('send', 'retrieve_new', 'retrieve_all', 'post')
+DEFAULT_MIX = 'send=6,retrieve_new=3,retrieve_all=0.5,post=0.5'
+
+
+def user_name(user_id:int) -> str:
+    return 'load_user_%d' % user_id
+
+
+def simulate_user(user_id:int, config:dict, start_at:float, deadline:float, stats:dict,
+                  lock:threading.Lock) -> None:
+    """
+    Runs one simulated user from start_at until deadline (time.time() values) and adds
+    what it did to stats.
+
+    :param user_id: number of the user (0 .. users-1)
+    :param config: settings built by main (host, port, users, fanout, think, mix, ...)
+    :param start_at: when to start
+    :param deadline: when to stop
+    :param stats: op -> {"samples": [...], "errors": {type: count}}, shared by the
+                  users of one process
+    :param lock: guards stats
+    """
+    rng = random.Random(config['seed'] * 1000003 + user_id)
+    name = user_name(user_id)
+    users = config['users']
+    recipients = [user_name((user_id + k) % users) for k in range(1, config['fanout'] + 1)] or [name]
+    dm = DirectMessenger(config['host'], name, PASSWORD, keep_alive=config['keep_alive'], port=config['port'])
+    ops, weights = zip(*config['mix'].items())
+    payload = 'x' * config['size']
+    think = config['think']
+    #spreads the first requests of all users over one think time
+    time.sleep(max(0.0, start_at - time.time()) + rng.uniform(0, think))
+    local = {op: {'samples': [], 'errors': {}} for op in ops}
+    try:
+        _loop(dm, rng, ops, weights, recipients, payload, config, deadline, local)
+    finally:
+        dm.close()
+        with lock:
+            for op, entry in local.items():
+                into = stats.setdefault(op, {'samples': [], 'errors': {}})
+                into['samples'].extend(entry['samples'])
+                for kind, n in entry['errors'].items():
+                    into['errors'][kind] = into['errors'].get(kind, 0) + n
+
+
+def _loop(dm, rng, ops, weights, recipients, payload, config, deadline, local) -> None:
+    think = config['think']
+    name = dm.username
+    while time.time() < deadline:
+        op = rng.choices(ops, weights)[0]
+        start = time.perf_counter()
+        error = None
+        try:
+            if op == 'send':
+                ok = dm.send(payload, rng.choice(recipients))
+            elif op == 'retrieve_new':
+                ok = dm.retrieve_new() is not None
+            elif op == 'retrieve_all':
+                ok = dm.retrieve_all() is not None
+            else:
+                ok = _post(config['host'], config['port'], name, payload)
+            if not ok:
+                error = 'server'
+        except Exception as e:
+            error = type(e).__name__
+        elapsed = time.perf_counter() - start
+        entry = local[op]
+        if error is None:
+            entry['samples'].append(elapsed)
+        else:
+            entry['errors'][error] = entry['errors'].get(error, 0) + 1
+        if think:
+            time.sleep(min(rng.expovariate(1 / think), max(0.0, deadline - time.time())))
+
+
+def _post(host:str, port:int, username:str, payload:str) -> bool:
+    #one journal post the way ds_client does it: connect, join, post
+    client = ds_protocol.connect_server(host, port)
+    try:
+        token = ds_protocol.join(client, username, PASSWORD)
+        if token == "error":
+            return False
+        return ds_protocol.post(client, token, {'entry': payload, 'timestamp': time.time()}) == "ok"
+    finally:
+        client.close()
+
+
+def run_process(user_ids:list, config:dict, start_at:float, deadline:float) -> dict:
+    """
+    Runs the given users as threads of the calling process (the body of one pool worker).
+
+    :return: op -> {"samples": [...], "errors": {type: count}}
+    :rtype: dict
+    """
+    stats = {}
+    lock = threading.Lock()
+    threads = [threading.Thread(target=simulate_user, args=(user_id, config, start_at, deadline, stats, lock),
+                                daemon=True) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats
+
+
+def run(config:dict, processes:int, duration:float) -> dict:
+    """
+    Spreads config["users"] simulated users over processes worker processes, lets them
+    run for duration seconds and merges what they report.
+
+    :return: op -> {"samples": [...], "errors": {type: count}} over all workers
+    :rtype: dict
+    """
+    processes = max(1, min(processes, config['users']))
+    groups = [list(range(i, config['users'], processes)) for i in range(processes)]
+    #leaves the workers time to start before the clock runs
+    start_at = time.time() + 1.0
+    deadline = start_at + duration
+    #spawn, not fork: this process may be running the server emulator thread
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes) as pool:
+        parts = pool.starmap(run_process, [(group, config, start_at, deadline) for group in groups])
+    merged = {}
+    for part in parts:
+        for op, entry in part.items():
+            into = merged.setdefault(op, {'samples': [], 'errors': {}})
+            into['samples'].extend(entry['samples'])
+            for kind, n in entry['errors'].items():
+                into['errors'][kind] = into['errors'].get(kind, 0) + n
+    return merged
+
+
+def report(merged:dict, duration:float) -> list:
+    """
+    Turns merged samples into one row per operation (plus a "total" row).
+
+    :return: list of dicts with n, errors, error_rate, ops_per_sec and latency percentiles
+    :rtype: list
+    """
+    rows = []
+    everything = []
+    all_errors = {}
+    for op in OPERATIONS:
+        if op not in merged:
+            continue
+        entry = merged[op]
+        rows.append(_row(op, entry['samples'], entry['errors'], duration))
+        everything.extend(entry['samples'])
+        for kind, n in entry['errors'].items():
+            all_errors[kind] = all_errors.get(kind, 0) + n
+    rows.append(_row('total', everything, all_errors, duration))
+    return rows
+
+
+def _row(op:str, samples:list, errors:dict, duration:float) -> dict:
+    failed = sum(errors.values())
+    attempts = len(samples) + failed
+    row = {'op': op, 'n': attempts, 'errors': failed, 'error_types': dict(errors),
+           'error_rate': round(failed / attempts, 4) if attempts else 0.0,
+           'ops_per_sec': round(len(samples) / duration, 2)}
+    if samples:
+        latency = summarize(samples)
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'mean_ms'):
+            row[key] = latency[key]
+    return row
+
+
+def _mix(text:str) -> dict:
+    mix = {}
+    for part in text.split(','):
+        if not part:
+            continue
+        op, _, weight = part.partition('=')
+        if op not in OPERATIONS:
+            raise argparse.ArgumentTypeError("unknown operation: " + op)
+        mix[op] = float(weight or 1)
+    if not mix or not any(mix.values()):
+        raise argparse.ArgumentTypeError("the mix needs at least one operation with a weight")
+    return mix
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Simulate many concurrent DS messenger users")
+    parser.add_argument('--users', type=int, default=100, help="simulated users")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to run")
+    parser.add_argument('--think', type=float, default=1000.0, help="mean think time between operations in ms")
+    parser.add_argument('--mix', type=_mix, default=DEFAULT_MIX,
+                        help="operation weights, e.g. " + DEFAULT_MIX)
+    parser.add_argument('--fanout', type=int, default=5, help="distinct recipients per user")
+    parser.add_argument('--size', type=int, default=64, help="characters per message or post")
+    parser.add_argument('--one-shot', action='store_true', help="connect and join for every call instead of keep_alive")
+    parser.add_argument('--server', default=None, help="DS server to load (default: start a local emulator)")
+    parser.add_argument('--port', type=int, default=3021)
+    parser.add_argument('--latency', type=float, default=0.0, help="emulator latency per response in ms")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default=None, help="write the report as json to this file")
+    args = parser.parse_args(argv)
+
+    config = {
+        'users': max(1, args.users),
+        'fanout': max(0, args.fanout),
+        'think': args.think / 1000,
+        'mix': args.mix,
+        'size': args.size,
+        'keep_alive': not args.one_shot,
+        'seed': args.seed,
+        }
+    with contextlib.ExitStack() as stack:
+        if args.server is None:
+            srv = stack.enter_context(ServerThread(latency=args.latency / 1000))
+            config['host'], config['port'] = srv.host, srv.port
+        else:
+            config['host'], config['port'] = args.server, args.port
+        started = time.perf_counter()
+        merged = run(config, args.processes, args.duration)
+        elapsed = time.perf_counter() - started
+
+    rows = report(merged, args.duration)
+    print('%d users, %d processes, %.1fs (wall %.1fs)' % (config['users'], min(args.processes, config['users']),
+                                                         args.duration, elapsed))
+    for row in rows:
+        print('%-13s n=%-8d err=%6.2f%% %10.1f ops/s  p50=%9.3fms p95=%9.3fms p99=%9.3fms'
+              % (row['op'], row['n'], row['error_rate'] * 100, row['ops_per_sec'],
+                 row.get('p50_ms', 0), row.get('p95_ms', 0), row.get('p99_ms', 0)))
+    if args.out:
+        settings = dict(config, processes=args.processes, duration=args.duration)
+        with open(args.out, 'w') as f:
+            json.dump({'settings': settings, 'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
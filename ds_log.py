@@ -0,0 +1,198 @@
+# ds_log.py
+#
+# Level-gated logging and a ring buffer of recent protocol exchanges for the DS clients
+#
+# The clients used to print every server response. They now report through LOG instead:
+#
+# - log lines (debug, info, warning, error) go to the standard "ds" logger, but only at
+#   or above LOG.level; call sites on the request path check the level first, so a
+#   disabled level costs one comparison and never formats anything
+# - every request written and response read is recorded (cut to max_chars) in a
+#   bounded in-memory ring buffer, which costs one deque append and no I/O. dump() writes
+#   the buffer out when something goes wrong, with passwords and tokens masked
+#
+#     import ds_log
+#     ds_log.set_level('debug')
+#     ...
+#     ds_log.dump()
+#
+# DS_LOG_LEVEL (debug, info, warning, error, off) sets the starting level (default
+# warning) and DS_LOG_BUFFER the number of exchanges kept (default 200, 0 turns it off).
+
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+OFF = logging.CRITICAL + 10
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR, 'off': OFF}
+
+#"password": "...", "token": "..." in a recorded request or response
+_SECRET = re.compile(r'("(?:password|token)"\s*:\s*)"(?:[^"\\]|\\.)*"')
+
+
+class Log:
+    """
+    The Log class gates log lines by level and keeps the most recent protocol exchanges.
+    """
+    def __init__(self, level:int = WARNING, capacity:int = 200, max_chars:int = 1000, logger:str = 'ds'):
+        """
+        Constructs all the necessary attributes for the Log object.
+
+        :param level: lowest level that is emitted (OFF emits nothing)
+        :param capacity: exchanges kept in the ring buffer (0 records nothing)
+        :param max_chars: characters kept of each request or response
+        :param logger: name of the standard logger lines are emitted to
+        """
+        self.level = level
+        self.max_chars = max_chars
+        self.logger = logging.getLogger(logger)
+        self._lock = threading.Lock()
+        self._buffer = deque(maxlen=0)
+        self.resize(capacity)
+
+
+    def resize(self, capacity:int) -> None:
+        """
+        Changes how many exchanges the ring buffer keeps (0 turns recording off).
+        """
+        with self._lock:
+            self._buffer = deque(self._buffer, maxlen=max(0, capacity))
+            self.recording = capacity > 0
+
+
+    def record(self, direction:str, data) -> None:
+        """
+        Adds one exchange to the ring buffer. Callers check LOG.recording first.
+
+        :param direction: "send" or "recv"
+        :param data: the request or response line (str or bytes)
+        """
+        entry = (time.time(), direction, data[:self.max_chars], len(data))
+        with self._lock:
+            self._buffer.append(entry)
+
+
+    def log(self, level:int, message:str, /, **fields) -> None:
+        """
+        Emits message with key=value fields if level is enabled.
+
+        :param level: DEBUG, INFO, WARNING or ERROR
+        :param message: what happened
+        :param fields: structured details; they are also passed to handlers as
+                       record.ds_fields
+        """
+        if level < self.level:
+            return
+        if fields:
+            message = message + ' ' + ' '.join('%s=%s' % item for item in fields.items())
+        self.logger.log(level, message, extra={'ds_fields': fields})
+
+
+    def debug(self, message:str, /, **fields) -> None:
+        self.log(DEBUG, message, **fields)
+
+
+    def info(self, message:str, /, **fields) -> None:
+        self.log(INFO, message, **fields)
+
+
+    def warning(self, message:str, /, **fields) -> None:
+        self.log(WARNING, message, **fields)
+
+
+    def error(self, message:str, /, **fields) -> None:
+        self.log(ERROR, message, **fields)
+
+
+    def recent(self) -> list:
+        """
+        Returns the buffered exchanges, oldest first, with secrets masked.
+
+        :return: list of {"time", "direction", "data", "size", "cut"} dicts; size is the
+                 length of the whole line and cut tells whether data is only its start
+        :rtype: list
+        """
+        with self._lock:
+            entries = list(self._buffer)
+        result = []
+        for stamp, direction, data, size in entries:
+            cut = len(data) < size
+            if isinstance(data, (bytes, bytearray)):
+                data = bytes(data).decode('utf-8', 'replace')
+            result.append({'time': stamp, 'direction': direction, 'size': size, 'cut': cut,
+                           'data': _SECRET.sub(r'\1"***"', data.rstrip('\r\n'))})
+        return result
+
+
+    def dump(self, file=None, level:int = ERROR) -> int:
+        """
+        Writes out the buffered exchanges, oldest first: to file if one is given,
+        otherwise through the logger at level (if it is enabled).
+
+        :param file: writable text file
+        :param level: log level used when no file is given
+        :return: number of exchanges written
+        :rtype: int
+        """
+        if file is None and level < self.level:
+            return 0
+        entries = self.recent()
+        for entry in entries:
+            line = '%s %s %s%s' % (time.strftime('%H:%M:%S', time.localtime(entry['time'])), entry['direction'],
+                                   entry['data'], ' ...' if entry['cut'] else '')
+            if file is not None:
+                file.write(line + '\n')
+            else:
+                self.logger.log(level, line)
+        return len(entries)
+
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buffer.clear()
+
+
+def _level(value) -> int:
+    if isinstance(value, int):
+        return value
+    if value.isdigit():
+        return int(value)
+    return LEVELS[value.lower()]
+
+
+def set_level(level) -> None:
+    """
+    Sets the lowest level that is emitted: DEBUG ... ERROR, OFF, or their names.
+
+    If nothing is configured to handle the "ds" logger, lines go to stderr.
+    """
+    LOG.level = _level(level)
+    if LOG.level >= OFF:
+        return
+    if LOG.logger.getEffectiveLevel() > LOG.level:
+        #without this the standard logger would drop what LOG lets through
+        LOG.logger.setLevel(LOG.level)
+    if LOG.level < WARNING and not LOG.logger.hasHandlers():
+        #logging's last resort handler only shows warnings and errors
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        LOG.logger.addHandler(handler)
+
+
+LOG = Log(capacity=int(os.environ.get('DS_LOG_BUFFER') or 200))
+set_level(os.environ.get('DS_LOG_LEVEL') or 'warning')
+
+
+def recent() -> list:
+    return LOG.recent()
+
+
+def dump(file=None) -> int:
+    return LOG.dump(file)
@@ -1,5 +1,13 @@
-import socket
-import json, time
+import socket, select
+import json, time, sys, codecs, math
+from array import array
+
+from ds_metrics import METRICS, command_name
+from ds_limiter import LIMITER
+from ds_log import LOG, DEBUG
+
+#requests that do the same thing when the server gets them twice
+IDEMPOTENT = frozenset(("join", "bio", "directmessage.all"))
 
 
 class DSUProtocolError(Exception):
@@ -9,26 +17,51 @@ class DSUProtocolError(Exception):
     pass
 
 
+class DSUConnectionError(DSUProtocolError):
+    """
+    Raised when the connection to the DS server cannot be opened or has been dropped,
+    as opposed to the server answering with an error response.
+    """
+    pass
+
+
+def to_timestamp(value) -> float:
+    """
+    Converts a message timestamp to a float. The server keeps whatever the sender wrote,
+    so one that is not a finite number is read as 0 (older than any real message).
+
+    :rtype: float
+    """
+    try:
+        ts = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return ts if math.isfinite(ts) else 0.0
+
+
 class DirectMessage:
     """
     The DirectMessage class is responsible for working with individual messages.
     It currently supports getters and setters for all of the attributes.
+    Instances use __slots__, so they carry no per-instance __dict__.
     """
-    def __init__(self):
+    __slots__ = ('recipient', 'message', 'timestamp')
+
+    def __init__(self, recipient:str = None, message:str = None, timestamp:float = None):
         """
         Constructs all the necessary attributes for DirectMessage object.
 
         :param recipient: sender or reciever of DirectMessage
         :param message: the message being sent or received from DS server
-        :param timestamp: time when the message was sent
+        :param timestamp: time when the message was sent (defaults to now)
         :type recipient: str (default None)
         :type message: str (default None)
         :type timestamp: float
         
         """
-        self.recipient = None
-        self.message = None
-        self.timestamp = time.time()
+        self.recipient = recipient
+        self.message = message
+        self.timestamp = time.time() if timestamp is None else timestamp
 
 
     def set_recipient(self, rec:str) -> None:
@@ -91,6 +124,230 @@ class DirectMessage:
         return self.timestamp
 
 
+class MessageColumns:
+    """
+    The MessageColumns class stores many messages column by column instead of as one
+    object each.
+
+    Senders are kept once in a table and referenced by index from an array, timestamps
+    live in a float array and bodies in a plain string table. Indexing or iterating gives
+    MessageView objects, which have the same getters as DirectMessage, so code written
+    against a list of DirectMessage objects keeps working.
+    """
+    __slots__ = ('_names', '_name_ids', '_senders', '_times', '_bodies')
+
+    def __init__(self, messages=()):
+        """
+        Constructs all the necessary attributes for the MessageColumns object.
+
+        :param messages: iterable of DirectMessage-like objects to start with
+        """
+        self._names = []
+        self._name_ids = {}
+        self._senders = array('I')
+        self._times = array('d')
+        self._bodies = []
+        for dm in messages:
+            self.append(dm.get_recipient(), dm.get_message(), dm.get_time())
+
+
+    @classmethod
+    def from_response(cls, messages:list) -> 'MessageColumns':
+        """
+        Builds the columns straight from the "messages" list of a DS server response.
+
+        :param messages: list of {"message", "from", "timestamp"} dicts
+        :type messages: list
+        :rtype: MessageColumns
+        """
+        cols = cls()
+        for msgs in messages:
+            cols.append(msgs["from"], msgs["message"], msgs["timestamp"])
+        return cols
+
+
+    def append(self, recipient:str, message:str, timestamp) -> None:
+        """
+        Adds one message to the end of the columns.
+
+        :param recipient: sender or reciever of the message
+        :param message: body of the message
+        :param timestamp: time of the message (str or float; see to_timestamp)
+        """
+        name_id = self._name_ids.get(recipient)
+        if name_id is None:
+            name_id = self._name_ids[recipient] = len(self._names)
+            self._names.append(sys.intern(recipient))
+        self._senders.append(name_id)
+        self._times.append(to_timestamp(timestamp))
+        self._bodies.append(message)
+
+
+    def senders(self) -> list:
+        """
+        Returns every distinct sender, in the order they first appear.
+
+        :rtype: list
+        """
+        return list(self._names)
+
+
+    def __len__(self) -> int:
+        return len(self._bodies)
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [MessageView(self, j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('message index out of range')
+        return MessageView(self, i)
+
+
+    def __iter__(self):
+        for i in range(len(self._bodies)):
+            yield MessageView(self, i)
+
+
+class MessageView:
+    """
+    Read-only view of one message inside a MessageColumns object, with the same getters
+    as DirectMessage.
+    """
+    __slots__ = ('_cols', '_i')
+
+    def __init__(self, cols:MessageColumns, i:int):
+        self._cols = cols
+        self._i = i
+
+
+    @property
+    def recipient(self) -> str:
+        return self._cols._names[self._cols._senders[self._i]]
+
+
+    @property
+    def message(self) -> str:
+        return self._cols._bodies[self._i]
+
+
+    @property
+    def timestamp(self) -> float:
+        return self._cols._times[self._i]
+
+
+    def get_recipient(self) -> str:
+        return self.recipient
+
+
+    def get_message(self) -> str:
+        return self.message
+
+
+    def get_time(self) -> float:
+        return self.timestamp
+
+
+class ResponseStream:
+    """
+    Incremental reader for one DS server response line.
+
+    Responses to a "directmessage" retrieve carry every message in one json line. Instead
+    of reading that whole line and decoding it at once, ResponseStream reads the socket
+    in chunks, finds the "messages" array and decodes its elements one at a time, so only
+    the element being decoded (and one chunk) has to be held in memory.
+    """
+    CHUNK = 64 * 1024
+
+    def __init__(self, read):
+        """
+        :param read: callable returning the next chunk of bytes (b'' once the stream ends)
+        :type read: function
+        """
+        self._read = read
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._done = False
+
+
+    def _fill(self) -> None:
+        data = self._read(self.CHUNK)
+        if not data:
+            raise DSUConnectionError("the server closed the connection")
+        #drops what has already been parsed so the buffer stays about one chunk long
+        self._buf = self._buf[self._pos:] + self._decoder.decode(data)
+        self._pos = 0
+
+
+    def header(self):
+        """
+        Reads up to the start of the "messages" array.
+
+        :return: None if a messages array follows, otherwise the complete response
+                 (e.g. an error) as a dict
+        :raises DSUProtocolError: the response could not be read
+        """
+        while True:
+            start = self._buf.find('"messages"', self._pos)
+            newline = self._buf.find('\n', self._pos)
+            if newline != -1 and (start == -1 or newline < start):
+                line = self._buf[self._pos:newline]
+                self._pos = newline + 1
+                self._done = True
+                try:
+                    return json.loads(line)
+                except ValueError:
+                    raise DSUProtocolError("an error occurred while connecting")
+            if start != -1:
+                bracket = self._buf.find('[', start)
+                if bracket != -1:
+                    between = self._buf[start + len('"messages"'):bracket]
+                    if between.strip() != ':':
+                        raise DSUProtocolError("an error occurred while connecting")
+                    self._pos = bracket + 1
+                    return None
+            self._fill()
+
+
+    def __iter__(self):
+        """
+        Yields the message dicts of the array one at a time, then reads to the end of the line.
+        """
+        buf_ws = ' \t\r\n,'
+        while not self._done:
+            while self._pos < len(self._buf) and self._buf[self._pos] in buf_ws:
+                self._pos += 1
+            if self._pos >= len(self._buf):
+                self._fill()
+                continue
+            if self._buf[self._pos] == ']':
+                self._pos += 1
+                self._finish()
+                return
+            try:
+                obj, end = self._json.raw_decode(self._buf, self._pos)
+            except ValueError:
+                #the element is cut off at the end of the buffer (or broken, in which case
+                #the server will eventually end the line and _fill/raw_decode keeps failing)
+                if '\n' in self._buf[self._pos:]:
+                    raise DSUProtocolError("an error occurred while connecting")
+                self._fill()
+                continue
+            self._pos = end
+            yield obj
+
+
+    def _finish(self) -> None:
+        while '\n' not in self._buf[self._pos:]:
+            self._fill()
+        self._pos = self._buf.index('\n', self._pos) + 1
+        self._done = True
+
+
 class DirectMessenger:
     """
     The DirectMessenger class exposes the properties required to send direct messages to the
@@ -100,23 +357,64 @@ class DirectMessenger:
     When creating a program, you can use the DirectMessenger with attr username and password
     to establish a connection and send messages. It also has functionality to retrieve new and
     all messages directed towards the user specified in the initialization signature.
+
+    By default every call opens a new connection, joins and disconnects again. Passing
+    keep_alive=True turns on session mode: one socket and one token are kept open across
+    calls, a dead connection is reopened transparently and join is only sent when there is
+    no token yet or the server rejects the one held. The connect_count and join_count
+    attributes show how many connects and joins were actually done.
     """
-    def __init__(self, dsuserver=None, username=None, password=None):
+    def __init__(self, dsuserver=None, username=None, password=None, keep_alive=False, port=3021,
+                 token_cache=None, search_index=None, timeout:float = None):
         """
         Constructs all the necessary attributes for the DirectMessenger object.
 
-        :param dsuserver: server to connect to (auto set to ICS 32 DS server)
+        :param dsuserver: server to connect to (defaults to the ICS 32 DS server)
         :param username: username to connect with DS server
         :param password: password for the username
+        :param keep_alive: keep one authenticated connection open across calls
+        :param port: port the DS server is listening on
+        :param token_cache: optional ds_tokens.TokenCache; the last token is reused instead of joining
+        :param search_index: optional ds_search.MessageSearch; retrieved messages are added to it
+        :param timeout: seconds to wait on the socket before giving up (None waits forever)
         :type dsuserver: str
         :type username: str
         :type password: str
+        :type keep_alive: bool
+        :type port: int
+        :type token_cache: TokenCache
+        :type search_index: MessageSearch
+        :type timeout: float
         
         """
         self.token = None
-        self.dsuserver = '168.235.86.101'
+        self.dsuserver = dsuserver or '168.235.86.101'
+        self.port = port
+        self.token_cache = token_cache
+        self.search_index = search_index
+        self.timeout = timeout
         self.username = username
         self.password = password
+        self.keep_alive = keep_alive
+        #counters for how many connects and joins were actually sent
+        self.connect_count = 0
+        self.join_count = 0
+        #why the last send failed (None after a successful one)
+        self.last_error = None
+        self._token_checked = False
+        #a request was written and its response has not been read yet
+        self._unanswered = False
+        self._sock = None
+        self.f_send = None
+        self.f_recv = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 		
     def send(self, message:str, recipient:str) -> bool:
         """
@@ -126,113 +424,499 @@ class DirectMessenger:
         :param recipient: person you are sending the message to
         :type message: str
         :type recipient: str
-        :return: true if message successfully sent, false if send failed.
+        :return: true if message successfully sent, false if send failed (last_error
+                 then says why).
         :rtype: bool
         """
+        self.last_error = None
         try:
             #establishes connection and sends a join message for token
-            self.connect()
-            self.join()
+            self._begin()
             
             dm = DirectMessage()
             dm.set_recipient(recipient)
             dm.set_message(message)
 
             x = {
-                "token": self.token,
                 "directmessage": {
                     "entry": dm.get_message(),
                     "recipient": dm.get_recipient(),
                     "timestamp": dm.get_time()
                     }
                 }
-            send_msg = json.dumps(x)
-            self.writeCom(send_msg)
-            resp = self.response()
+            resp = self._request(x)
             #disconnects from the server (closes sockets)
-            self.disconnect()
+            self._end()
             
             if resp["response"]["type"] == 'ok':
                 return True
             else:
+                self.last_error = _message(resp)
                 return False
         except DSUProtocolError as dse:
-            print(dse)
+            self.last_error = str(dse)
+            LOG.warning(str(dse), op='directmessage.send', recipient=recipient)
 
 
-    def retrieve_new(self) -> list:
+    def send_many(self, messages, window:int = 64, errors:list = None) -> list:
         """
-        Retrieves all the new messages from the DS Server and converts them to DirectMessage objects.
+        Sends many DirectMessages over one connection, the session's one in keep-alive
+        mode, joining at most once.
 
-        :return: returns a list of DirectMessage objects containing all new messages
+        Requests are written back to back, with up to window of them waiting for a
+        response at any time, so the whole batch costs about one round trip per window
+        instead of a connect, join and round trip per message. messages may be a
+        generator; it is consumed lazily.
+
+        If the connection breaks, the messages already written are reported as failed
+        and the rest of messages is not consumed, so the result can be shorter than the
+        input.
+
+        :param messages: iterable of (message, recipient) pairs, or (message, recipient,
+                         timestamp) to keep the time a message was written
+        :param window: most requests waiting for a response at once
+        :param errors: optional list that gets one entry per result: None for an accepted
+                       message, otherwise the server's error message or the connection error
+        :type window: int
+        :type errors: list
+        :return: one bool per message, true if the server accepted it
         :rtype: list
         """
+        results = []
+        pending = 0
+        start = time.perf_counter()
+        limited = LIMITER.enabled
         try:
-            #establishes connection and sends a join message for token
-            self.connect()
-            self.join()
-            response_list = []
+            #the session's connection and token are reused, like send does
+            self._begin()
+            messages = iter(messages)
+            if not self._token_checked:
+                #a token the server dropped would fail every item, so the first one goes
+                #alone through _request, which joins again if the token is turned down
+                for item in messages:
+                    try:
+                        self._request(_send_body(item))
+                        results.append(True)
+                        if errors is not None:
+                            errors.append(None)
+                    except DSUProtocolError as dse:
+                        results.append(False)
+                        if errors is not None:
+                            errors.append(str(dse))
+                        if isinstance(dse, DSUConnectionError):
+                            raise
+                    break
+                if not self.is_connected():
+                    #one-shot mode drops the connection after an error response
+                    self.disconnect()
+                    self.connect()
+            for item in messages:
+                if pending >= max(1, window):
+                    self.f_send.flush()
+                    results.append(self._batch_result(limited, errors))
+                    pending -= 1
+                if limited:
+                    #while the limiter says wait, collect our own responses (they free slots)
+                    while not LIMITER.acquire(timeout=0 if pending else None):
+                        self.f_send.flush()
+                        results.append(self._batch_result(limited, errors))
+                        pending -= 1
+                x = {"token": self.token}
+                x.update(_send_body(item))
+                line = json.dumps(x) + '\n'
+                #counted before the write, so a failed write also gives back its limiter slot
+                pending += 1
+                try:
+                    self.f_send.write(line)
+                    if LOG.recording:
+                        LOG.record('send', line)
+                except (OSError, ValueError, AttributeError):
+                    raise DSUConnectionError("an error occurred while connecting")
+                if METRICS.enabled:
+                    METRICS.add_bytes(sent=len(line.encode('utf-8')))
+            try:
+                self.f_send.flush()
+            except (OSError, ValueError, AttributeError):
+                raise DSUConnectionError("an error occurred while connecting")
+            while pending:
+                results.append(self._batch_result(limited, errors))
+                pending -= 1
+            self._end()
+        except DSUProtocolError as dse:
+            LOG.warning(str(dse), op='directmessage.send_many', unanswered=pending)
+            results.extend([False] * pending)
+            if errors is not None:
+                errors.extend([str(dse)] * pending)
+            if limited:
+                for _ in range(pending):
+                    LIMITER.release(False)
+            #responses may still be on their way; they must not answer later requests
+            self.disconnect()
+        if METRICS.enabled:
+            METRICS.observe("directmessage.send_many", time.perf_counter() - start, count=len(results))
+        return results
 
-            x = {
-                "token": self.token,
-                "directmessage": "new"
-                }
-            retrieve_msg = json.dumps(x)
-            self.writeCom(retrieve_msg)
-            resp = self.response()
 
-            #loops through response list and creates DirectMessage objects with provide attr
-            for msgs in resp["response"]["messages"]:
-                dm = DirectMessage()
-                dm.set_message(msgs["message"])
-                dm.set_recipient(msgs["from"])
-                dm.set_time(msgs["timestamp"])
+    def _batch_result(self, limited:bool = False, errors:list = None) -> bool:
+        ok = self._read_response()["response"]["type"] == 'ok'
+        if not ok and METRICS.enabled:
+            METRICS.error('server', message=self.resp_msg["response"].get("message"))
+        if limited:
+            LIMITER.release(ok)
+        if errors is not None:
+            errors.append(None if ok else _message(self.resp_msg) or "an error occurred while connecting")
+        return ok
 
-                response_list.append(dm)
 
-            #disconnects from the server (closes sockets)
-            self.disconnect()
-            return response_list
+    def retrieve_new(self, columnar:bool = False) -> list:
+        """
+        Retrieves all the new messages from the DS Server and converts them to DirectMessage objects.
+
+        :param columnar: return a compact MessageColumns instead of a list
+        :type columnar: bool
+        :return: returns a list of DirectMessage objects containing all new messages
+        :rtype: list
+        """
+        try:
+            return self._retrieve("new", columnar)
         except DSUProtocolError as dse:
-            print(dse)
+            LOG.warning(str(dse), op='directmessage.new')
             
         
  
-    def retrieve_all(self) -> list:
+    def retrieve_all(self, columnar:bool = False) -> list:
         """
         Retrieves all the messages from the DS Server and converts them to DirectMessage objects.
 
+        :param columnar: return a compact MessageColumns instead of a list (for large histories)
+        :type columnar: bool
         :return: returns a list of DirectMessage objects containing all messages
         :rtype: list
         """
         try:
-            #establishes connection and sends a join message for token
-            self.connect()
+            return self._retrieve("all", columnar)
+        except DSUProtocolError as dse:
+            LOG.warning(str(dse), op='directmessage.all')
+
+
+    def _retrieve(self, kind:str, columnar:bool = False) -> list:
+        """
+        Shared body of retrieve_new and retrieve_all.
+
+        :param kind: "new" or "all"
+        :param columnar: return a MessageColumns instead of a list
+        :type kind: str
+        :type columnar: bool
+        :raises DSUProtocolError: custom error for failed connections
+        :return: list of DirectMessage objects
+        :rtype: list
+        """
+        #establishes connection and sends a join message for token
+        self._begin()
+
+        resp = self._request({"directmessage": kind})
+
+        #loops through response list and creates DirectMessage objects with provide attr
+        if columnar:
+            response_list = MessageColumns.from_response(resp["response"]["messages"])
+        else:
+            response_list = [DirectMessage(msgs["from"], msgs["message"], msgs["timestamp"])
+                             for msgs in resp["response"]["messages"]]
+        if self.search_index is not None:
+            self.search_index.add(response_list)
+
+        #disconnects from the server (closes sockets)
+        self._end()
+        return response_list
+
+
+    def search(self, query:str, limit:int = 100) -> list:
+        """
+        Searches the messages this messenger has retrieved so far (needs a search_index).
+
+        :param query: words that must all appear in the message
+        :param limit: most messages to return
+        :type query: str
+        :type limit: int
+        :return: list of DirectMessage objects, most recently retrieved first
+        :rtype: list
+        """
+        if self.search_index is None:
+            return []
+        return self.search_index.search(query, limit)
+
+
+    def iter_new(self):
+        """
+        Generator version of retrieve_new that yields DirectMessage objects while the
+        response is still being read from the socket.
+
+        :raises DSUProtocolError: custom error for failed connections or error responses
+        """
+        return self._iter_messages("new")
+
+
+    def iter_all(self):
+        """
+        Generator version of retrieve_all. Memory use stays bounded no matter how big the
+        inbox is and the first messages are available before the download finishes.
+
+        The connection is only free again once the generator is exhausted; stopping early
+        closes it.
+
+        :raises DSUProtocolError: custom error for failed connections or error responses
+        """
+        return self._iter_messages("all")
+
+
+    def _iter_messages(self, kind:str):
+        start = time.perf_counter()
+        self._begin()
+        joins = self.join_count
+        stream, resp = self._stream_header({"directmessage": kind})
+        if (resp is not None and not self._token_checked and self.join_count == joins
+                and self._token_rejected(_message(resp))):
+            #the server may have dropped our token; join again and retry once
             self.join()
-            response_list = []
+            stream, resp = self._stream_header({"directmessage": kind})
+        if resp is not None:
+            self.resp_msg = resp
+            if LOG.recording:
+                LOG.record('recv', json.dumps(resp))
+            if not self.keep_alive:
+                self.disconnect()
+            message = _message(resp) or "an error occurred while connecting"
+            if METRICS.enabled:
+                METRICS.error('server', command="directmessage." + kind)
+            raise DSUProtocolError(message)
+
+        finished = False
+        count = 0
+        try:
+            for msgs in stream:
+                count += 1
+                dm = DirectMessage(msgs["from"], msgs["message"], msgs["timestamp"])
+                if self.search_index is not None:
+                    self.search_index.add((dm,))
+                yield dm
+            finished = True
+        finally:
+            if LOG.recording:
+                #the messages themselves are not kept, only how many were streamed
+                LOG.record('recv', '{"response": {"type": "ok", "messages": [%d streamed%s]}}'
+                           % (count, '' if finished else ', unfinished'))
+            #an unfinished response would be read as the answer to the next request
+            if not finished:
+                self.disconnect()
+        self._end()
+        if METRICS.enabled:
+            METRICS.observe("directmessage." + kind, time.perf_counter() - start, streamed=True)
 
-            x = {
-                "token": self.token,
-                "directmessage": "all"
-                }
-            retrieve_msg = json.dumps(x)
-            self.writeCom(retrieve_msg)
-            resp = self.response()
 
-            #loops through response list and creates DirectMessage objects with provide attr
-            for msgs in resp["response"]["messages"]:
-                dm = DirectMessage()
-                dm.set_message(msgs["message"])
-                dm.set_recipient(msgs["from"])
-                dm.set_time(msgs["timestamp"])
+    def _stream_header(self, body:dict) -> tuple:
+        """
+        Writes a streamed request and reads up to the start of its messages, going
+        through the shared rate limiter when it is on.
 
-                response_list.append(dm)
+        :return: the ResponseStream and its header (None if messages follow)
+        :rtype: tuple
+        """
+        if not LIMITER.enabled:
+            stream = self._stream_request(body)
+            return stream, stream.header()
+        LIMITER.acquire()
+        ok = False
+        try:
+            stream = self._stream_request(body)
+            resp = stream.header()
+            ok = resp is None
+            return stream, resp
+        finally:
+            LIMITER.release(ok)
 
-            #disconnects from the server (closes sockets)
+
+    def _stream_request(self, body:dict) -> ResponseStream:
+        x = {"token": self.token}
+        x.update(body)
+        self.writeCom(json.dumps(x))
+        read = self.f_recv.buffer.read1
+        if METRICS.enabled:
+            def read(n, _read=read):
+                data = _read(n)
+                METRICS.add_bytes(received=len(data))
+                return data
+        return ResponseStream(read)
+
+
+    def _begin(self) -> None:
+        """
+        Makes sure there is an open, joined connection before a request is written.
+        Outside of session mode this is always a fresh connect, and a join unless a
+        token cache supplies the token.
+
+        :raises DSUProtocolError: custom error for failed connections
+        """
+        joins = self.join_count
+        if self.token is None and self.token_cache is not None:
+            self.token = self.token_cache.get(self.dsuserver, self.port, self.username)
+        if self.keep_alive:
+            #a token held from an earlier connection is tried first; _request joins
+            #again if the server turns it down
+            if not self.is_connected():
+                self.disconnect()
+                self.connect()
+            if self.token is None:
+                self.join()
+        else:
             self.disconnect()
-            return response_list
+            self.connect()
+            if self.token_cache is None or self.token is None:
+                self.join()
+        #a token that was just handed out is not worth retrying with a new join
+        self._token_checked = self.join_count != joins
+
+
+    def _end(self) -> None:
+        """
+        Closes the connection after a call unless session mode is on.
+        """
+        if not self.keep_alive:
+            self.disconnect()
+
+
+    def _request(self, body:dict) -> dict:
+        """
+        Adds the token to body, writes it and returns the server's response.
+
+        In session mode a request that hits a dead connection is retried once on a new
+        connection. A request made with a token that was not obtained during this call
+        (session mode or a token cache) is retried once after a fresh join if the server
+        answers that the token is invalid, since the server may have dropped that token;
+        any other error response is raised right away. With the rate limiter on, a
+        request whose connection still breaks is retried up to LIMITER.retries more
+        times; the limiter has slowed down after the failure, so each retry waits its
+        turn.
+
+        A request is only sent again after a broken connection if it never reached the
+        server or is in IDEMPOTENT; otherwise (e.g. a send that may have been delivered)
+        the DSUConnectionError is raised.
+
+        :param body: json body of the request without the token
+        :type body: dict
+        :raises DSUProtocolError: custom error for failed connections
+        :return: dictionary conversion of json message response
+        :rtype: dict
+        """
+        if not LIMITER.enabled:
+            return self._request_once(body)
+        attempt = 0
+        while True:
+            try:
+                return self._request_once(body)
+            except DSUConnectionError:
+                #error responses are answers, not failures worth sending again
+                if attempt >= LIMITER.retries or not self._may_resend(body):
+                    raise
+            attempt += 1
+            if METRICS.enabled:
+                METRICS.count('retries')
+            if not self.is_connected():
+                self._begin()
+
+
+    def _request_once(self, body:dict) -> dict:
+        """
+        One attempt of _request (with its reconnect and re-join retries).
+
+        :param body: json body of the request without the token
+        :type body: dict
+        :raises DSUProtocolError: custom error for failed connections
+        :return: dictionary conversion of json message response
+        :rtype: dict
+        """
+        joins = self.join_count
+        try:
+            return self._exchange(body)
+        except DSUConnectionError:
+            if not self.keep_alive or not self._may_resend(body):
+                raise
+            if METRICS.enabled:
+                METRICS.count('reconnects')
+            self.disconnect()
+            self.connect()
+            self.join()
         except DSUProtocolError as dse:
-            print(dse)
+            #only worth re-joining if the server turned down a token that was not fresh
+            #for this request; any other error response is the answer to the request
+            if self._token_checked or self.join_count != joins or not self._token_rejected(str(dse)):
+                raise
+            if METRICS.enabled:
+                METRICS.count('rejoins')
+            if not self.is_connected():
+                self.disconnect()
+                self.connect()
+            self.join()
+        return self._exchange(body)
+
+
+    def _may_resend(self, body:dict) -> bool:
+        """
+        Tells whether body can be written again after its connection broke: either the
+        last request never got onto the connection or doing it twice is harmless.
+
+        :rtype: bool
+        """
+        return not self._unanswered or command_name(body) in IDEMPOTENT
+
+
+    def _token_rejected(self, message:str) -> bool:
+        """
+        Tells whether an error message says the token is not valid (the server answers
+        "Invalid user token." to a token it does not know).
+
+        :param message: message of the error response
+        :rtype: bool
+        """
+        return isinstance(message, str) and 'token' in message.lower()
+
+
+    def _exchange(self, body:dict) -> dict:
+        """
+        Writes one request carrying the current token and reads its response.
+
+        :param body: json body of the request without the token
+        :type body: dict
+        :raises DSUProtocolError: custom error for failed connections
+        :return: dictionary conversion of json message response
+        :rtype: dict
+        """
+        x = {"token": self.token}
+        x.update(body)
+        if not METRICS.enabled:
+            return self._roundtrip(json.dumps(x))
+        start = time.perf_counter()
+        resp = self._roundtrip(json.dumps(x))
+        METRICS.observe(command_name(body), time.perf_counter() - start)
+        return resp
+
+
+    def _roundtrip(self, msg:str) -> dict:
+        """
+        Writes one request line and reads its response (see response), going through
+        the shared rate limiter when it is on.
+        """
+        if not LIMITER.enabled:
+            self.writeCom(msg)
+            return self.response()
+        LIMITER.acquire()
+        ok = False
+        try:
+            self.writeCom(msg)
+            resp = self.response()
+            ok = True
+            return resp
+        finally:
+            LIMITER.release(ok)
 
 
     def join(self) -> None:
@@ -250,14 +934,24 @@ class DirectMessenger:
                     }
                 }
             join_msg = json.dumps(x)
-            self.writeCom(join_msg)
-            resp = self.response()
+            self.join_count += 1
+            start = time.perf_counter()
+            resp = self._roundtrip(join_msg)
+            if METRICS.enabled:
+                METRICS.observe("join", time.perf_counter() - start)
 
             #makes sure a response is given from the server
             if resp is not None:
                 self.token = resp["response"]["token"]
+        except DSUConnectionError:
+            raise
         except:
+            self.token = None
+            if self.token_cache is not None:
+                self.token_cache.forget(self.dsuserver, self.port, self.username)
             raise DSUProtocolError("an error occurred while connecting")
+        if self.token_cache is not None:
+            self.token_cache.put(self.dsuserver, self.port, self.username, self.token)
         
 
     def connect(self) -> None:
@@ -266,22 +960,66 @@ class DirectMessenger:
 
         :raises DSUProtocolError: custom error for failed connections
         """
+        start = time.perf_counter()
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.dsuserver, 3021))
+            sock.settimeout(self.timeout)
+            sock.connect((self.dsuserver, self.port))
 
+            self._sock = sock
             self.f_send = sock.makefile('w')
             self.f_recv = sock.makefile('r')
+            self._unanswered = False
+            self.connect_count += 1
         except:
-            raise DSUProtocolError("an error occurred while connecting")
+            if METRICS.enabled:
+                METRICS.error('connection', phase='connect')
+            raise DSUConnectionError("an error occurred while connecting")
+        if METRICS.enabled:
+            METRICS.observe("connect", time.perf_counter() - start)
+            METRICS.count('connects')
+
+
+    def is_connected(self) -> bool:
+        """
+        Checks without blocking whether the current connection is still usable.
+
+        :return: true if a socket is open and the server has not closed it
+        :rtype: bool
+        """
+        if self._sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([self._sock], [], [], 0)
+            if readable:
+                #a readable socket with nothing to peek at means the server hung up
+                return self._sock.recv(1, socket.MSG_PEEK) != b''
+            return True
+        except (OSError, ValueError):
+            return False
 
 
     def disconnect(self) -> None:
         """
         Disconnects the user from the server by closing the sockets.
         """
-        self.f_send.close()
-        self.f_recv.close()
+        for f in (self.f_send, self.f_recv, self._sock):
+            if f is not None:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+        self._sock = None
+        self.f_send = None
+        self.f_recv = None
+
+
+    def close(self) -> None:
+        """
+        Ends the session: closes the connection and forgets the token.
+        """
+        self.disconnect()
+        self.token = None
 
 
     def writeCom(self, msg:str) -> None:
@@ -290,46 +1028,109 @@ class DirectMessenger:
 
         :param msg: json message to send to DS server
         :type msg: str
-        :raises DSUProtocolError: custom error for failed connections
+        :raises DSUConnectionError: the connection is not usable
         """
+        self._unanswered = False
         try:
             self.f_send.write(msg + '\n')
             self.f_send.flush()
+            self._unanswered = True
+            if LOG.recording:
+                LOG.record('send', msg)
         except:
-            raise DSUProtocolError("an error occurred while connecting")
+            if METRICS.enabled:
+                METRICS.error('connection', phase='write')
+            raise DSUConnectionError("an error occurred while connecting")
+        if METRICS.enabled:
+            METRICS.add_bytes(sent=len(msg.encode('utf-8')) + 1)
 
 
     def response(self) -> dict:
         """
         Abstracted function that takes responses from the server
 
-        :raises DSUProtocolError: custom error for failed connections
+        :raises DSUConnectionError: the connection broke before a response arrived
+        :raises DSUProtocolError: the response was an error or could not be read
         :return: dictionary conversion of json message response
         :rtype: dict
         """
-        try: 
-            resp = self.f_recv.readline()[:-1]
+        self._read_response()
+        if LOG.level <= DEBUG:
+            #message bodies stay out of the log; the ring buffer has the raw line
+            LOG.debug('response', type=self.resp_msg["response"]["type"],
+                      message=self.resp_msg["response"].get("message"),
+                      messages=len(self.resp_msg["response"].get("messages", ())))
 
-            self.resp_msg = json.loads(resp)
+        if self.resp_msg["response"]["type"] == 'error':
+            if METRICS.enabled:
+                METRICS.error('server', message=self.resp_msg["response"].get("message"))
+            #a rejected request does not break the session, so only drop one-shot connections
+            if not self.keep_alive:
+                self.disconnect()
+            raise DSUProtocolError(self.resp_msg["response"].get("message", "an error occurred while connecting"))
+        return self.resp_msg
 
-            #prints response to the console
-            if "message" in self.resp_msg["response"]:
-                print(self.resp_msg["response"]["message"])
-            elif len(self.resp_msg["response"]["messages"]) > 1:
-                #only shows the last message (for simplicity in console)
-                print('...', self.resp_msg["response"]["messages"][-1])
-            else:
-                print(self.resp_msg["response"]["messages"])
 
-            if self.resp_msg["response"]["type"] == 'error':
+    def _read_response(self) -> dict:
+        """
+        Reads and decodes one response line, whatever its type, into self.resp_msg.
 
-                #print(self.resp_msg["response"]["message"])
-                self.disconnect()
-                raise DSUProtocolError
-            else:
-                return self.resp_msg
+        :raises DSUConnectionError: the connection broke before a response arrived
+        :raises DSUProtocolError: the response could not be read
+        :return: dictionary conversion of json message response
+        :rtype: dict
+        """
+        try:
+            resp = self.f_recv.readline()
+        except:
+            if METRICS.enabled:
+                METRICS.error('connection', phase='read')
+            #after a timeout the reader is unusable and a late response could answer the
+            #next request, so the next call starts on a new connection
+            self.disconnect()
+            raise DSUConnectionError("an error occurred while connecting")
+        if not resp:
+            if METRICS.enabled:
+                METRICS.error('connection', phase='read')
+            self.disconnect()
+            raise DSUConnectionError("the server closed the connection")
+        self._unanswered = False
+        if METRICS.enabled:
+            METRICS.add_bytes(received=len(resp.encode('utf-8')))
+        if LOG.recording:
+            LOG.record('recv', resp)
+
+        try: 
+            self.resp_msg = json.loads(resp)
+            self.resp_msg["response"]["type"]
         except:
+            if METRICS.enabled:
+                METRICS.error('decode')
+            LOG.error('undecodable response from the server; recent exchanges follow')
+            LOG.dump()
             raise DSUProtocolError("an error occurred while connecting")
+        return self.resp_msg
+
+
+def _send_body(item) -> dict:
+    #directmessage request (without the token) for a send_many item
+    return {
+        "directmessage": {
+            "entry": item[0],
+            "recipient": item[1],
+            "timestamp": item[2] if len(item) > 2 else time.time()
+            }
+        }
+
+
+def _message(resp) -> str:
+    #message of a decoded error response, or None
+    try:
+        message = resp["response"]["message"]
+    except (KeyError, TypeError):
+        return None
+    return message if isinstance(message, str) else None
+
 
 """
 Practice Test
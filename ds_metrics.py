@@ -0,0 +1,273 @@
+# ds_metrics.py
+#
+# Built-in metrics for the DS clients
+#
+# ds_protocol and ds_messenger report every request here: a latency histogram per
+# protocol command, bytes in and out, connects, reconnects and errors by type. Metrics
+# are off by default and every call site checks METRICS.enabled first, so the cost when
+# disabled is one attribute lookup. Turn them on with enable() or DS_METRICS=1.
+#
+#     import ds_metrics
+#     ds_metrics.enable()
+#     ...
+#     print(ds_metrics.stats())
+#     ds_metrics.PrometheusDumper('/var/lib/node_exporter/ds.prom', 15).start()
+
+import bisect
+import os
+import threading
+import time
+
+#upper bounds (seconds) of the latency histogram buckets; the last bucket is unbounded
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram (the same shape Prometheus uses).
+    """
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, seconds:float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+    def percentile(self, q:float) -> float:
+        """
+        Estimates the q-th percentile (0-100) by interpolating inside its bucket.
+
+        :rtype: float
+        """
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = BUCKETS[i - 1] if i else 0.0
+                high = BUCKETS[i] if i < len(BUCKETS) else low * 2 or 1.0
+                return low + (high - low) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+
+class Metrics:
+    """
+    The Metrics class collects the numbers reported by the clients.
+
+    Hooks registered with add_hook are called as hook(event, name, value, info) for
+    every observation ("latency", "error", "count", "bytes_in" and "bytes_out"), so
+    requests can be forwarded to an outside tracer.
+    """
+    def __init__(self, enabled:bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._hooks = []
+        self.reset()
+
+
+    def reset(self) -> None:
+        """
+        Clears every histogram and counter.
+        """
+        with self._lock:
+            self.latency = {}
+            self.counters = {}
+            self.errors = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.started = time.time()
+
+
+    def add_hook(self, hook) -> None:
+        self._hooks.append(hook)
+
+
+    def remove_hook(self, hook) -> None:
+        self._hooks.remove(hook)
+
+
+    def observe(self, name:str, seconds:float, **info) -> None:
+        """
+        Records the latency of one operation, e.g. a protocol command.
+
+        :param name: operation ("connect", "join", "directmessage.send", ...)
+        :param seconds: how long it took
+        :type name: str
+        :type seconds: float
+        """
+        with self._lock:
+            hist = self.latency.get(name)
+            if hist is None:
+                hist = self.latency[name] = Histogram()
+            hist.observe(seconds)
+        for hook in self._hooks:
+            hook('latency', name, seconds, info)
+
+
+    def count(self, name:str, n:int = 1) -> None:
+        """
+        Adds n to a counter such as "connects" or "reconnects".
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        for hook in self._hooks:
+            hook('count', name, n, {})
+
+
+    def error(self, kind:str, **info) -> None:
+        """
+        Counts one error of the given type (e.g. "connection", "server", "decode").
+        """
+        with self._lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+        for hook in self._hooks:
+            hook('error', kind, 1, info)
+
+
+    def add_bytes(self, sent:int = 0, received:int = 0) -> None:
+        with self._lock:
+            self.bytes_out += sent
+            self.bytes_in += received
+        for hook in self._hooks:
+            if sent:
+                hook('bytes_out', 'bytes', sent, {})
+            if received:
+                hook('bytes_in', 'bytes', received, {})
+
+
+    def stats(self) -> dict:
+        """
+        Returns a snapshot of everything collected so far.
+
+        :return: latency per operation (count, total, mean and estimated p50/p95/p99 in
+                 seconds), byte totals, counters and errors by type
+        :rtype: dict
+        """
+        with self._lock:
+            latency = {}
+            for name, hist in self.latency.items():
+                latency[name] = {
+                    'count': hist.count,
+                    'sum': hist.sum,
+                    'mean': hist.sum / hist.count if hist.count else None,
+                    'p50': hist.percentile(50),
+                    'p95': hist.percentile(95),
+                    'p99': hist.percentile(99),
+                    }
+            return {
+                'enabled': self.enabled,
+                'since': self.started,
+                'latency': latency,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'counters': dict(self.counters),
+                'errors': dict(self.errors),
+                }
+
+
+    def to_prometheus(self) -> str:
+        """
+        Renders the metrics in the Prometheus text exposition format.
+
+        :rtype: str
+        """
+        lines = []
+        with self._lock:
+            lines.append('# TYPE ds_request_seconds histogram')
+            for name, hist in sorted(self.latency.items()):
+                total = 0
+                for bound, n in zip(BUCKETS + (float('inf'),), hist.counts):
+                    total += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('ds_request_seconds_bucket{command="%s",le="%s"} %d' % (name, le, total))
+                lines.append('ds_request_seconds_sum{command="%s"} %r' % (name, hist.sum))
+                lines.append('ds_request_seconds_count{command="%s"} %d' % (name, hist.count))
+            lines.append('# TYPE ds_bytes_total counter')
+            lines.append('ds_bytes_total{direction="in"} %d' % self.bytes_in)
+            lines.append('ds_bytes_total{direction="out"} %d' % self.bytes_out)
+            lines.append('# TYPE ds_events_total counter')
+            for name, n in sorted(self.counters.items()):
+                lines.append('ds_events_total{event="%s"} %d' % (name, n))
+            lines.append('# TYPE ds_errors_total counter')
+            for kind, n in sorted(self.errors.items()):
+                lines.append('ds_errors_total{type="%s"} %d' % (kind, n))
+        return '\n'.join(lines) + '\n'
+
+
+class PrometheusDumper:
+    """
+    Writes METRICS to a Prometheus text file every interval seconds from a daemon thread
+    (for node_exporter's textfile collector). The file is replaced atomically.
+    """
+    def __init__(self, path:str, interval:float = 15.0, metrics:Metrics = None):
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics or METRICS
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ds-metrics-dump', daemon=True)
+
+
+    def start(self) -> 'PrometheusDumper':
+        self._thread.start()
+        return self
+
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.dump()
+
+
+    def dump(self) -> None:
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.metrics.to_prometheus())
+        os.replace(tmp, self.path)
+
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.dump()
+            except OSError:
+                pass
+
+
+def command_name(request:dict) -> str:
+    """
+    Names the protocol command of a request body for the per-command histograms.
+
+    :rtype: str
+    """
+    if "directmessage" in request:
+        dm = request["directmessage"]
+        return "directmessage." + (dm if isinstance(dm, str) else "send")
+    for name in ("join", "post", "bio"):
+        if name in request:
+            return name
+    return "other"
+
+
+METRICS = Metrics(enabled=os.environ.get('DS_METRICS', '') not in ('', '0'))
+
+
+def enable() -> None:
+    METRICS.enabled = True
+
+
+def disable() -> None:
+    METRICS.enabled = False
+
+
+def stats() -> dict:
+    return METRICS.stats()
@@ -0,0 +1,231 @@
+# ds_outbox.py
+#
+# Durable outbox for outgoing direct messages
+#
+# A send is appended to a local log file (one json line, flushed and fsynced) and the
+# caller returns right away; the messages are delivered later, in batches, by whoever
+# calls flush (the PollingWorker thread in the GUI). Deliveries are recorded in the same
+# log, so after a crash or a restart every message that was not confirmed by the server
+# is still pending. Delivery is at least once: a message whose "ok" was lost with the
+# connection is sent again.
+#
+# Log records:
+#
+#     {"id": 7, "message": "hi", "recipient": "friend", "timestamp": 1700000000.0}
+#     {"done": [7, 8, 9]}
+#     {"rejected": [10]}
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from ds_messenger import DirectMessage
+
+
+class Outbox:
+    """
+    The Outbox class keeps outgoing messages in an append-only log until the server has
+    accepted them.
+
+    add is safe to call from one thread while another thread runs flush.
+    """
+    def __init__(self, path:str, fsync:bool = True):
+        """
+        Constructs all the necessary attributes for the Outbox object and replays the log.
+
+        :param path: log file (created if missing)
+        :param fsync: fsync every append, so an accepted send survives a power loss
+        :type path: str
+        :type fsync: bool
+        """
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        #id -> DirectMessage, oldest first
+        self._pending = OrderedDict()
+        self._next_id = 1
+        self._finished = 0
+        self._load()
+        self._file = open(self.path, 'ab')
+        if self._finished:
+            self._compact()
+
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+
+    def add(self, message:str, recipient:str) -> int:
+        """
+        Stores a message for delivery. When this returns the message is on disk.
+
+        :param message: message wanting to be sent
+        :param recipient: person you are sending the message to
+        :type message: str
+        :type recipient: str
+        :return: id of the message in the outbox
+        :rtype: int
+        """
+        dm = DirectMessage(recipient, message)
+        with self._lock:
+            msg_id = self._next_id
+            self._next_id += 1
+            self._append({'id': msg_id, 'message': message, 'recipient': recipient,
+                          'timestamp': dm.get_time()})
+            self._pending[msg_id] = dm
+        return msg_id
+
+
+    def pending(self, limit:int = None) -> list:
+        """
+        Returns the undelivered messages, oldest first.
+
+        :param limit: most messages to return (None returns all of them)
+        :type limit: int
+        :return: list of (id, DirectMessage) pairs
+        :rtype: list
+        """
+        with self._lock:
+            items = iter(self._pending.items())
+            if limit is None:
+                return list(items)
+            return [item for _, item in zip(range(limit), items)]
+
+
+    def mark_delivered(self, ids:list) -> None:
+        """
+        Records that the server accepted the messages.
+        """
+        self._finish('done', ids)
+
+
+    def mark_rejected(self, ids:list) -> None:
+        """
+        Records that the server turned the messages down, so they are not retried.
+        """
+        self._finish('rejected', ids)
+
+
+    def flush(self, messenger, batch_size:int = 64) -> tuple:
+        """
+        Sends pending messages with messenger.send_many, one batch after another, until
+        the outbox is empty or a message has to wait.
+
+        Only a message the server turns down for what it is (see permanent_error) is
+        rejected. Any other failure, e.g. a lost connection, "Server busy" or a dropped
+        token, leaves it pending and ends the flush, so the caller can try again later.
+
+        :param messenger: messenger to send with (a keep-alive DirectMessenger)
+        :param batch_size: messages per send_many call
+        :type messenger: DirectMessenger
+        :type batch_size: int
+        :return: (delivered, rejected, complete) where delivered is a list of
+                 DirectMessage, rejected a list of (DirectMessage, error) pairs and
+                 complete is false if messages are left over
+        :rtype: tuple
+        """
+        delivered = []
+        rejected = []
+        while True:
+            batch = self.pending(batch_size)
+            if not batch:
+                return delivered, rejected, True
+            errors = []
+            results = messenger.send_many(((dm.get_message(), dm.get_recipient(), dm.get_time())
+                                           for _, dm in batch), window=batch_size, errors=errors)
+            done = [(msg_id, dm) for (msg_id, dm), ok in zip(batch, results) if ok]
+            self.mark_delivered([msg_id for msg_id, _ in done])
+            delivered.extend(dm for _, dm in done)
+            failed = [(msg_id, dm, error) for (msg_id, dm), ok, error in zip(batch, results, errors)
+                      if not ok and permanent_error(error)]
+            self.mark_rejected([msg_id for msg_id, _, _ in failed])
+            rejected.extend((dm, error) for _, dm, error in failed)
+            if len(done) + len(failed) < len(batch):
+                return delivered, rejected, False
+
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+    def _finish(self, kind:str, ids:list) -> None:
+        ids = list(ids)
+        if not ids:
+            return
+        with self._lock:
+            self._append({kind: ids})
+            for msg_id in ids:
+                if self._pending.pop(msg_id, None) is not None:
+                    self._finished += 1
+            if not self._pending:
+                #everything went out, so the log can start over
+                self._compact()
+
+
+    def _append(self, record:dict) -> None:
+        self._file.write(json.dumps(record).encode('utf-8') + b'\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+
+    def _load(self) -> None:
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        good = 0
+        with f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    #the last record was cut short by a crash
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                good = f.tell()
+                if 'id' in record:
+                    self._pending[record['id']] = DirectMessage(record['recipient'], record['message'],
+                                                                record['timestamp'])
+                    self._next_id = max(self._next_id, record['id'] + 1)
+                else:
+                    for msg_id in record.get('done', []) + record.get('rejected', []):
+                        if self._pending.pop(msg_id, None) is not None:
+                            self._finished += 1
+            end = f.tell()
+        if good < end:
+            with open(self.path, 'r+b') as f:
+                f.truncate(good)
+
+
+    def _compact(self) -> None:
+        #rewrites the log with only the pending messages
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for msg_id, dm in self._pending.items():
+                f.write(json.dumps({'id': msg_id, 'message': dm.get_message(), 'recipient': dm.get_recipient(),
+                                    'timestamp': dm.get_time()}).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp, self.path)
+        self._file = open(self.path, 'ab')
+        self._finished = 0
+
+
+def permanent_error(error:str) -> bool:
+    """
+    Tells whether an error response means the message itself will never be accepted.
+
+    The server names the part of a request it cannot take ("Invalid directmessage.");
+    everything else (an invalid token, "Server busy", a broken connection) may pass.
+
+    :rtype: bool
+    """
+    if not error:
+        return False
+    error = error.lower()
+    return error.startswith('invalid') and 'token' not in error
@@ -0,0 +1,198 @@
+# ds_pool.py
+#
+# Connection pool for driving many DS accounts at once
+#
+# Keeps a bounded number of keep-alive DirectMessenger connections, keyed by account.
+# Idle connections are reused by the next checkout for the same account; when the pool
+# is full the least recently used idle connection is closed to make room. Tokens are
+# remembered per account, so a connection that is re-created after an eviction starts
+# with the old token instead of a join.
+
+import contextlib
+import threading
+import time
+from collections import OrderedDict
+
+from ds_messenger import DirectMessenger
+
+
+class MessengerPool:
+    """
+    The MessengerPool class hands out authenticated DirectMessenger connections to
+    several threads.
+
+    A checked out messenger belongs to the calling thread until it is checked in again.
+    At most max_size connections exist at once; a checkout that finds the pool full of
+    busy connections waits for one to come back.
+    """
+    def __init__(self, dsuserver=None, port:int = 3021, max_size:int = 16):
+        """
+        Constructs all the necessary attributes for the MessengerPool object.
+
+        :param dsuserver: server to connect to (defaults to the ICS 32 DS server)
+        :param port: port the DS server is listening on
+        :param max_size: most connections open at once
+        :type dsuserver: str
+        :type port: int
+        :type max_size: int
+        """
+        self.dsuserver = dsuserver
+        self.port = port
+        self.max_size = max(1, max_size)
+        self._cond = threading.Condition()
+        #(username, password) -> idle messengers, least recently used account first
+        self._idle = OrderedDict()
+        self._tokens = {}
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.waits = 0
+
+
+    def checkout(self, username:str, password:str, timeout:float = None) -> DirectMessenger:
+        """
+        Takes a connection for the account out of the pool, opening one if needed.
+
+        :param username: account to act as
+        :param password: password for the account
+        :param timeout: most seconds to wait for a free slot (None waits forever)
+        :type username: str
+        :type password: str
+        :type timeout: float
+        :raises TimeoutError: no connection became free in time
+        :return: keep-alive DirectMessenger for the account
+        :rtype: DirectMessenger
+        """
+        key = (username, password)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+        victim = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("pool is closed")
+                idle = self._idle.get(key)
+                if idle:
+                    dm = idle.pop()
+                    if not idle:
+                        del self._idle[key]
+                    self.hits += 1
+                    self._in_use += 1
+                    return dm
+                if self._size < self.max_size:
+                    break
+                if self._idle:
+                    #makes room by closing the least recently used idle connection
+                    old_key, old = next(iter(self._idle.items()))
+                    victim = old.pop(0)
+                    if not old:
+                        del self._idle[old_key]
+                    self._size -= 1
+                    self.evictions += 1
+                    break
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("no connection became free in time")
+                self._cond.wait(remaining)
+            self._size += 1
+            self._in_use += 1
+            self.misses += 1
+            token = self._tokens.get(key)
+        if victim is not None:
+            victim.close()
+        dm = DirectMessenger(self.dsuserver, username, password, keep_alive=True, port=self.port)
+        dm.token = token
+        return dm
+
+
+    def checkin(self, dm:DirectMessenger) -> None:
+        """
+        Gives a checked out connection back to the pool.
+
+        :param dm: messenger returned by checkout
+        :type dm: DirectMessenger
+        """
+        key = (dm.username, dm.password)
+        with self._cond:
+            self._in_use -= 1
+            if dm.token is not None:
+                self._tokens[key] = dm.token
+            if self._closed:
+                self._size -= 1
+            else:
+                self._idle.setdefault(key, []).append(dm)
+                self._idle.move_to_end(key)
+            self._cond.notify()
+        if self._closed:
+            dm.close()
+
+
+    def discard(self, dm:DirectMessenger) -> None:
+        """
+        Closes a checked out connection instead of returning it (e.g. after an error).
+
+        :param dm: messenger returned by checkout
+        :type dm: DirectMessenger
+        """
+        with self._cond:
+            self._in_use -= 1
+            self._size -= 1
+            self._cond.notify()
+        dm.close()
+
+
+    @contextlib.contextmanager
+    def connection(self, username:str, password:str, timeout:float = None):
+        """
+        Context manager version of checkout/checkin.
+
+            with pool.connection('user', 'pass') as dm:
+                dm.send('hi', 'friend')
+        """
+        dm = self.checkout(username, password, timeout)
+        try:
+            yield dm
+        except BaseException:
+            self.discard(dm)
+            raise
+        self.checkin(dm)
+
+
+    def stats(self) -> dict:
+        """
+        Returns counters for sizing the pool.
+
+        :return: hits, misses, evictions and waits so far, plus open/idle/in-use connections
+        :rtype: dict
+        """
+        with self._cond:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'waits': self.waits,
+                'size': self._size,
+                'idle': self._size - self._in_use,
+                'in_use': self._in_use,
+                'max_size': self.max_size,
+                }
+
+
+    def close(self) -> None:
+        """
+        Closes every idle connection; connections still checked out are closed on checkin.
+        """
+        with self._cond:
+            self._closed = True
+            idle = [dm for lst in self._idle.values() for dm in lst]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for dm in idle:
+            dm.close()
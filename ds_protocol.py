@@ -2,19 +2,223 @@ import time
 import socket
 import json
 import ast
-from collections import namedtuple
-# Create a namedtuple to hold the values we expect to retrieve from json messages.
+import weakref
+
+from ds_metrics import METRICS, command_name
+from ds_limiter import LIMITER
+from ds_log import LOG, DEBUG
+
+# Optional fast json backend. orjson works on bytes directly; the standard json module is
+# used when it is not installed.
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def _loads(data):
+        return orjson.loads(data)
+
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    def _loads(data):
+        return json.loads(data)
+
+    JSON_BACKEND = 'json'
+
+
+#longest response line accepted from the server
+MAX_LINE = 64 * 1024 * 1024
+
+
+class LineReader:
+    '''
+    Buffered reader that splits what the server sends into lines.
+
+    Data is received straight into one reusable bytearray (recv_into through a memoryview),
+    so a response that arrives in many segments, or several responses that arrive in one,
+    are both handled without copying the buffer on every read.
+    '''
+    def __init__(self, sock, size: int = 65536):
+        self.sock = sock
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+        #where to continue looking for a newline, so a long line is not rescanned
+        self._scan = 0
+
+    def readline(self) -> bytes:
+        '''
+        Returns the next line without its line ending, or b'' once the server has closed
+        the connection and no data is left.
+        '''
+        while True:
+            nl = self._buf.find(b'\n', self._scan, self._end)
+            if nl != -1:
+                line = bytes(memoryview(self._buf)[self._start:nl])
+                self._start = self._scan = nl + 1
+                if LOG.recording:
+                    LOG.record('recv', line)
+                return line.rstrip(b'\r')
+            self._scan = self._end
+            if not self._fill():
+                line = bytes(memoryview(self._buf)[self._start:self._end])
+                self._start = self._scan = self._end
+                if LOG.recording and line:
+                    LOG.record('recv', line)
+                return line
+
+    def _fill(self) -> bool:
+        if self._start == self._end:
+            self._start = self._end = self._scan = 0
+        elif self._end == len(self._buf):
+            pending = self._end - self._start
+            if self._start:
+                #moves the unread part to the front instead of growing the buffer
+                self._buf[:pending] = memoryview(self._buf)[self._start:self._end]
+                self._scan -= self._start
+                self._start, self._end = 0, pending
+            if pending * 2 > len(self._buf):
+                #a long line: grow so every recv still has plenty of room
+                if len(self._buf) >= MAX_LINE:
+                    raise ValueError("response line too long")
+                self._buf.extend(bytes(len(self._buf)))
+        n = self.sock.recv_into(memoryview(self._buf)[self._end:])
+        self._end += n
+        if METRICS.enabled:
+            METRICS.add_bytes(received=n)
+        return n > 0
+
+
+class LineWriter:
+    '''
+    Writes json requests as newline terminated lines.
+    '''
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, obj) -> None:
+        data = _dumps(obj) + b'\n'
+        self.sock.sendall(data)
+        if LOG.recording:
+            LOG.record('send', data)
+        if METRICS.enabled:
+            METRICS.add_bytes(sent=len(data))
+
+    def write_many(self, objs) -> None:
+        '''
+        Writes several requests with one sendall.
+        '''
+        lines = [_dumps(obj) + b'\n' for obj in objs]
+        data = b''.join(lines)
+        self.sock.sendall(data)
+        if LOG.recording:
+            for line in lines:
+                LOG.record('send', line)
+        if METRICS.enabled:
+            METRICS.add_bytes(sent=len(data))
+
+
+#one reader per socket, so data buffered during one call is still there for the next
+_readers = weakref.WeakKeyDictionary()
+
+
+def reader_for(client) -> LineReader:
+    reader = _readers.get(client)
+    if reader is None:
+        reader = _readers[client] = LineReader(client)
+    return reader
+
+
+def write_request(client, obj: dict) -> None:
+    '''
+    Sends one json request to the server.
+    '''
+    LineWriter(client).write(obj)
+
+
+def read_response(client) -> dict:
+    '''
+    Reads and decodes the next response line from the server. Returns an error response
+    if the connection was closed or the line is not valid json.
+    '''
+    line = reader_for(client).readline()
+    try:
+        resp = _loads(line)
+    except ValueError:
+        if METRICS.enabled:
+            METRICS.error('connection' if not line else 'decode')
+        return {"response": {"type": "error", "message": "Json cannot be decoded."}}
+    if METRICS.enabled and response_type(resp) == "error":
+        METRICS.error('server', message=resp["response"].get("message"))
+    return resp
+
+
+def send_request(client, obj: dict) -> dict:
+    '''
+    Sends one json request and returns the decoded response.
+    '''
+    if LIMITER.enabled:
+        return _limited(_send_request, client, obj)
+    return _send_request(client, obj)
+
+
+def response_type(resp) -> str:
+    '''
+    Returns the type ("ok" or "error") of a decoded response, or None if resp is not a
+    response envelope (e.g. the server sent valid json of another shape).
+    '''
+    if not isinstance(resp, dict):
+        return None
+    inner = resp.get("response")
+    return inner.get("type") if isinstance(inner, dict) else None
+
+
+def _send_request(client, obj: dict) -> dict:
+    if not METRICS.enabled:
+        write_request(client, obj)
+        return read_response(client)
+    start = time.perf_counter()
+    write_request(client, obj)
+    resp = read_response(client)
+    METRICS.observe(command_name(obj), time.perf_counter() - start)
+    return resp
+
+
+def _limited(func, client, obj: dict) -> dict:
+    '''
+    Runs one request through the shared rate limiter; error responses, timeouts and
+    broken connections count as failures.
+    '''
+    LIMITER.acquire()
+    ok = False
+    try:
+        resp = func(client, obj)
+        decoded = resp
+        if isinstance(resp, bytes):
+            try:
+                decoded = _loads(resp)
+            except ValueError:
+                decoded = None
+        ok = response_type(decoded) == "ok"
+        return resp
+    finally:
+        LIMITER.release(ok)
 
 
 def extract_token(json_msg: str) -> str:
     '''
     Call the json.loads function on a json string and convert it to a string object
     '''
+    token = None
     try:
-        json_obj = json.loads(json_msg)
+        json_obj = _loads(json_msg)
         token = json_obj['response']['token']
-    except json.JSONDecodeError:
-        print("Json cannot be decoded.")
+    except ValueError:
+        LOG.warning("Json cannot be decoded.")
 
     return token
 
@@ -23,44 +227,79 @@ def extract_type(json_msg: str) -> str:
     '''
     Call the json.loads function on a json string and convert it to a string object
     '''
+    type = None
     try:
-        json_obj = json.loads(json_msg)
+        json_obj = _loads(json_msg)
         type = json_obj['response']['type']
-    except json.JSONDecodeError:
-        print("Json cannot be decoded.")
+    except (ValueError, KeyError, TypeError):
+        LOG.warning("Json cannot be decoded.")
 
     return type
 
 
 def connect_server(server: str, port: int):
+    start = time.perf_counter()
     client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.connect((server, port))
+    try:
+        client.connect((server, port))
+    except OSError:
+        if METRICS.enabled:
+            METRICS.error('connection', phase='connect')
+        raise
+    if METRICS.enabled:
+        METRICS.observe("connect", time.perf_counter() - start)
+        METRICS.count('connects')
     return client
 
 
 def join(client, username: str, password: str):
-    msg = '{"join": {"username":' + '"' + username + '"' + ',"password":' + '"' + password + '", "token":""}}'
-    client.sendall(msg.encode('utf-8'))
-    srv_msg = client.recv(4096)
-    decode_srv_msg = srv_msg.decode('utf-8')
-    print("Response", decode_srv_msg)
-    if extract_type(decode_srv_msg) == "error":
-        return "error"
-    elif extract_type(decode_srv_msg) == "ok":
-        return extract_token(srv_msg.decode('utf-8'))
+    start = time.perf_counter()
+    request = {"join": {"username": username, "password": password, "token": ""}}
+    if LIMITER.enabled:
+        srv_msg = _limited(_join_line, client, request)
+    else:
+        srv_msg = _join_line(client, request)
+    if METRICS.enabled:
+        METRICS.observe("join", time.perf_counter() - start)
+    if LOG.level <= DEBUG:
+        #the raw response carries the token; the ring buffer masks it, the log leaves it out
+        LOG.debug("join", username=username, type=extract_type(srv_msg))
+    if extract_type(srv_msg) == "ok":
+        return extract_token(srv_msg)
+    return "error"
+
+
+def _join_line(client, request: dict) -> bytes:
+    write_request(client, request)
+    return reader_for(client).readline()
+
+
+def to_entry(message) -> dict:
+    '''
+    Accepts a post as a dict, a json string or the str() of a dict (the format ds_client
+    has always passed), and returns it as a dict with entry and timestamp.
+    '''
+    if isinstance(message, dict):
+        convert_message = message
+    else:
+        try:
+            convert_message = _loads(message)
+        except ValueError:
+            try:
+                convert_message = ast.literal_eval(message)
+            except (ValueError, SyntaxError):
+                convert_message = None
+        if not isinstance(convert_message, dict):
+            #plain text is posted as is
+            convert_message = {'entry': str(message), 'timestamp': time.time()}
+    return {"entry": str(convert_message.get('entry')), "timestamp": str(convert_message.get('timestamp'))}
 
 
 def post(client, token: str, message: str):
-    convert_message=ast.literal_eval(message)
-    msg = '{"token":' + '"' + token + '"' + ', "post": {"entry":"' + str(convert_message.get('entry')) + '", "timestamp": "'\
-          + str(convert_message.get('timestamp')) + '"}}'
-    client.sendall(msg.encode('utf-8'))
-    srv_msg = client.recv(4096)
+    resp = send_request(client, {"token": token, "post": to_entry(message)})
+    return response_type(resp)
 
 
 def bio(client, token: str, bio: str):
-    msg = '{"token":' + '"' + token + '"' + ', "bio": {"entry":"' + bio + '", "timestamp": "' + str(
-        time.time()) + '"}}'
-    client.sendall(msg.encode('utf-8'))
-    srv_msg = client.recv(4096)
-
+    resp = send_request(client, {"token": token, "bio": {"entry": bio, "timestamp": str(time.time())}})
+    return response_type(resp)
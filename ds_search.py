@@ -0,0 +1,177 @@
+# ds_search.py
+#
+# Full-text search over direct messages
+#
+# SearchIndex is an inverted index: every word maps to the ascending list (a compact
+# array) of the ids of the documents containing it. Documents are added one at a time,
+# so the index follows retrieve_new without ever being rebuilt. A query looks only at
+# the postings of its own words: the shortest list is walked from the newest id down and
+# every other word is checked with a binary search, so answering it costs about
+# limit * log(n) and not a scan of the history.
+#
+#     index = MessageSearch()
+#     index.add(messenger.retrieve_all())
+#     index.search('lunch tomorrow')
+
+import bisect
+import re
+from array import array
+
+_WORD = re.compile(r'\w+')
+
+
+def tokenize(text:str) -> list:
+    """
+    Splits text into lower-case words (letters, digits and underscores).
+
+    :param text: text to split
+    :type text: str
+    :rtype: list
+    """
+    return _WORD.findall(text.casefold()) if text else []
+
+
+class SearchIndex:
+    """
+    The SearchIndex class maps words to the ids of the documents containing them.
+
+    Ids are integers chosen by the caller (e.g. database row ids). Adding them in
+    ascending order keeps every add an append; an older id is still placed correctly.
+    """
+    def __init__(self):
+        #word -> ascending array of document ids
+        self._postings = {}
+        self._count = 0
+
+
+    def add(self, doc_id:int, text:str) -> None:
+        """
+        Indexes one document.
+
+        :param doc_id: id of the document
+        :param text: its text
+        :type doc_id: int
+        :type text: str
+        """
+        self.add_many(((doc_id, text),))
+
+
+    def add_many(self, documents) -> None:
+        """
+        Indexes many documents (the loop add would run, with the lookups hoisted out).
+
+        :param documents: iterable of (doc_id, text) pairs
+        """
+        postings = self._postings
+        findall = _WORD.findall
+        count = 0
+        for doc_id, text in documents:
+            count += 1
+            if not text:
+                continue
+            for word in set(findall(text.casefold())):
+                try:
+                    ids = postings[word]
+                except KeyError:
+                    postings[word] = array('q', (doc_id,))
+                    continue
+                if ids[-1] < doc_id:
+                    ids.append(doc_id)
+                else:
+                    i = bisect.bisect_left(ids, doc_id)
+                    if i == len(ids) or ids[i] != doc_id:
+                        ids.insert(i, doc_id)
+        self._count += count
+
+
+    def search(self, query:str, limit:int = 100) -> list:
+        """
+        Finds the documents that contain every word of query.
+
+        :param query: words to look for
+        :param limit: most ids to return (None returns every match)
+        :type query: str
+        :type limit: int
+        :return: matching ids, highest (newest) first
+        :rtype: list
+        """
+        words = set(tokenize(query))
+        if not words:
+            return []
+        lists = []
+        for word in words:
+            ids = self._postings.get(word)
+            if ids is None:
+                return []
+            lists.append(ids)
+        lists.sort(key=len)
+        shortest, others = lists[0], lists[1:]
+        found = []
+        for doc_id in reversed(shortest):
+            for ids in others:
+                i = bisect.bisect_left(ids, doc_id)
+                if i == len(ids) or ids[i] != doc_id:
+                    break
+            else:
+                found.append(doc_id)
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+
+    def terms(self) -> int:
+        """
+        Returns the number of distinct words in the index.
+
+        :rtype: int
+        """
+        return len(self._postings)
+
+
+    def __len__(self) -> int:
+        return self._count
+
+
+class MessageSearch:
+    """
+    The MessageSearch class indexes DirectMessage bodies in the order they are added and
+    answers queries with the messages themselves.
+    """
+    def __init__(self, messages=()):
+        """
+        Constructs all the necessary attributes for the MessageSearch object.
+
+        :param messages: iterable of DirectMessage objects to start with
+        """
+        self.index = SearchIndex()
+        self._messages = []
+        self.add(messages)
+
+
+    def add(self, messages) -> None:
+        """
+        Indexes messages.
+
+        :param messages: iterable of DirectMessage objects
+        """
+        start = len(self._messages)
+        self._messages.extend(messages)
+        self.index.add_many((i, self._messages[i].get_message()) for i in range(start, len(self._messages)))
+
+
+    def search(self, query:str, limit:int = 100) -> list:
+        """
+        Finds the messages that contain every word of query.
+
+        :param query: words to look for
+        :param limit: most messages to return (None returns every match)
+        :type query: str
+        :type limit: int
+        :return: list of DirectMessage objects, most recently added first
+        :rtype: list
+        """
+        return [self._messages[i] for i in self.index.search(query, limit)]
+
+
+    def __len__(self) -> int:
+        return len(self._messages)
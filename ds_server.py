@@ -0,0 +1,369 @@
+# ds_server.py
+#
+# Local stand-in for the ICS 32 DS server
+#
+# Implements join, post, bio and directmessage (send/new/all) with the same response
+# envelopes as the real server, so ds_protocol, ds_client, DirectMessenger and
+# AsyncDirectMessenger can be tested and benchmarked without touching 168.235.86.101.
+#
+# Run it with:
+#     python ds_server.py --port 3021 --latency 5 --history 100000
+# and point a client at it with DirectMessenger('127.0.0.1', 'user', 'pass').
+
+import argparse
+import asyncio
+import json
+import threading
+import time
+import uuid
+
+#largest request accepted from a client before the connection is dropped
+MAX_REQUEST = 1024 * 1024
+
+
+class DSServer:
+    """
+    The DSServer class is an asyncio emulator of the DS server.
+
+    Accounts are created on their first join and keep their token for the life of the
+    server, so a token can be reused across connections. Requests are json objects and
+    do not have to be newline terminated (ds_protocol does not send newlines); every
+    response is one json line.
+    """
+    def __init__(self, host:str = '127.0.0.1', port:int = 3021, latency:float = 0.0,
+                 history:int = 0, history_senders:int = 10, max_rate:float = 0.0):
+        """
+        Constructs all the necessary attributes for the DSServer object.
+
+        :param host: address to listen on
+        :param port: port to listen on (0 picks a free one)
+        :param latency: seconds to wait before answering each request
+        :param history: number of old messages every new account starts with
+        :param history_senders: number of distinct senders the old messages come from
+        :param max_rate: requests per second served before answering with errors, like an
+                         overloaded server (0 for no limit)
+        :type host: str
+        :type port: int
+        :type latency: float
+        :type history: int
+        :type history_senders: int
+        :type max_rate: float
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.history = history
+        self.history_senders = max(1, history_senders)
+        #username -> password, token -> username, username -> token
+        self.passwords = {}
+        self.tokens = {}
+        self.user_tokens = {}
+        #username -> every message received, and the ones not fetched with "new" yet
+        self.inboxes = {}
+        self.unread = {}
+        self.posts = {}
+        self.bios = {}
+        self.requests = 0
+        self.max_rate = max_rate
+        self.rejected = 0
+        #requests allowed right now (refilled at max_rate per second, up to one second's worth)
+        self._allowance = max_rate
+        self._allowance_stamp = time.monotonic()
+        self._server = None
+        #handler task -> its stream writer, for every open client connection
+        self._handlers = {}
+
+
+    async def start(self) -> None:
+        """
+        Starts listening. self.port holds the real port afterwards.
+        """
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+
+    async def stop(self) -> None:
+        """
+        Stops listening and drops every open client connection.
+        """
+        if self._server is not None:
+            self._server.close()
+        #closing the transports makes every handler see end of stream and return
+        for task, writer in list(self._handlers.items()):
+            writer.close()
+        if self._handlers:
+            await asyncio.wait(list(self._handlers))
+        if self._server is not None:
+            await self._server.wait_closed()
+
+
+    async def _handle(self, reader, writer) -> None:
+        task = asyncio.current_task()
+        self._handlers[task] = writer
+        decoder = json.JSONDecoder()
+        buf = ''
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buf += data.decode('utf-8', errors='replace')
+                pos = 0
+                while True:
+                    while pos < len(buf) and buf[pos] in ' \t\r\n':
+                        pos += 1
+                    if pos == len(buf):
+                        break
+                    try:
+                        req, pos = decoder.raw_decode(buf, pos)
+                    except ValueError:
+                        #either half a request (wait for more) or garbage up to a newline
+                        newline = buf.find('\n', pos)
+                        if newline != -1:
+                            pos = newline + 1
+                            await self._reply(writer, _error("Invalid JSON"))
+                            continue
+                        break
+                    await self._reply(writer, self.dispatch(req))
+                buf = buf[pos:]
+                if len(buf) > MAX_REQUEST:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self._handlers.pop(task, None)
+            writer.close()
+
+
+    async def _reply(self, writer, resp:dict) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        writer.write((json.dumps(resp) + '\n').encode('utf-8'))
+        await writer.drain()
+
+
+    def dispatch(self, req) -> dict:
+        """
+        Answers one decoded request.
+
+        :param req: the request as sent by a client
+        :return: the response envelope
+        :rtype: dict
+        """
+        self.requests += 1
+        if self.max_rate and not self._allow():
+            self.rejected += 1
+            return _error("Server busy, try again later.")
+        if not isinstance(req, dict):
+            return _error("Invalid JSON")
+        if "join" in req:
+            return self._join(req["join"])
+        username = self.tokens.get(req.get("token"))
+        if username is None:
+            return _error("Invalid user token.")
+        if "directmessage" in req:
+            return self._directmessage(username, req["directmessage"])
+        if "post" in req:
+            entry = _entry(req["post"])
+            if entry is None:
+                return _error("Invalid post.")
+            self.posts.setdefault(username, []).append(entry)
+            return _ok("Post published to DS Server")
+        if "bio" in req:
+            entry = _entry(req["bio"])
+            if entry is None:
+                return _error("Invalid bio.")
+            self.bios[username] = entry
+            return _ok("Bio published to DS Server")
+        return _error("Invalid request.")
+
+
+    def _allow(self) -> bool:
+        now = time.monotonic()
+        self._allowance = min(self.max_rate, self._allowance + (now - self._allowance_stamp) * self.max_rate)
+        self._allowance_stamp = now
+        if self._allowance < 1:
+            return False
+        self._allowance -= 1
+        return True
+
+
+    def _join(self, join) -> dict:
+        try:
+            username = join["username"]
+            password = join["password"]
+        except (KeyError, TypeError):
+            return _error("Invalid join request.")
+        if not isinstance(username, str) or not username.strip() or not isinstance(password, str):
+            return _error("Invalid username or password.")
+        if username not in self.passwords:
+            self.passwords[username] = password
+            token = str(uuid.uuid4())
+            self.tokens[token] = username
+            self.user_tokens[username] = token
+            #messages may have been sent to the name before it ever joined
+            self.inboxes[username] = self._seed_history() + self.inboxes.get(username, [])
+            message = "Welcome to the ICS 32 Distributed Social!"
+        elif self.passwords[username] != password:
+            return _error("Invalid password or username already taken")
+        else:
+            message = "Welcome back, " + username
+        resp = _ok(message)
+        resp["response"]["token"] = self.user_tokens[username]
+        return resp
+
+
+    def _seed_history(self) -> list:
+        return _make_history(self.history, self.history_senders)
+
+
+    def seed(self, username:str, count:int, senders:int = None, size:int = 0) -> None:
+        """
+        Replaces the inbox of username with count old (already read) messages.
+
+        :param username: account to fill
+        :param count: number of messages
+        :param senders: number of distinct senders (defaults to history_senders)
+        :param size: pad every message body to at least this many characters
+        :type username: str
+        :type count: int
+        :type senders: int
+        :type size: int
+        """
+        self.inboxes[username] = _make_history(count, senders or self.history_senders, size)
+        self.unread.pop(username, None)
+
+
+    def _directmessage(self, username:str, dm) -> dict:
+        if dm == "new":
+            return {"response": {"type": "ok", "messages": self.unread.pop(username, [])}}
+        if dm == "all":
+            return {"response": {"type": "ok", "messages": self.inboxes.get(username, [])}}
+        if not isinstance(dm, dict):
+            return _error("Invalid directmessage.")
+        recipient = dm.get("recipient")
+        entry = dm.get("entry")
+        if not isinstance(recipient, str) or not recipient or not isinstance(entry, str):
+            return _error("Invalid directmessage.")
+        message = {"message": entry, "from": username, "timestamp": str(dm.get("timestamp", time.time()))}
+        self.inboxes.setdefault(recipient, []).append(message)
+        self.unread.setdefault(recipient, []).append(message)
+        return _ok("Direct message sent")
+
+
+def _make_history(count:int, senders:int, size:int = 0) -> list:
+    now = time.time()
+    pad = 'x' * max(0, size - len("history message %d" % count))
+    return [{"message": "history message %d" % i + pad,
+             "from": "sender%d" % (i % senders),
+             "timestamp": str(now - count + i)}
+            for i in range(count)]
+
+
+def _ok(message:str) -> dict:
+    return {"response": {"type": "ok", "message": message}}
+
+
+def _error(message:str) -> dict:
+    return {"response": {"type": "error", "message": message}}
+
+
+def _entry(obj):
+    if isinstance(obj, dict) and isinstance(obj.get("entry"), str) and obj["entry"].strip():
+        return obj
+    return None
+
+
+class ServerThread:
+    """
+    Runs a DSServer on its own event loop in a background thread, for tests, benchmarks
+    and scripts that are not asyncio themselves.
+
+    Use it as a context manager:
+
+        with ServerThread(latency=0.001) as srv:
+            dm = DirectMessenger(srv.host, 'user', 'pass', port=srv.port)
+    """
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: passed on to DSServer (port defaults to 0, a free port)
+        """
+        kwargs.setdefault('port', 0)
+        self.server = DSServer(**kwargs)
+        self._loop = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ds-server', daemon=True)
+
+
+    @property
+    def host(self) -> str:
+        return self.server.host
+
+
+    @property
+    def port(self) -> int:
+        return self.server.port
+
+
+    def start(self) -> None:
+        self._thread.start()
+        self._ready.wait()
+
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self.server.stop(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+    def _run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self.server.start())
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Local stand-in for the ICS 32 DS server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3021)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="milliseconds to wait before every response")
+    parser.add_argument('--history', type=int, default=0,
+                        help="old messages every new account starts with")
+    parser.add_argument('--senders', type=int, default=10,
+                        help="distinct senders of the old messages")
+    parser.add_argument('--max-rate', type=float, default=0.0,
+                        help="requests per second before answering with errors (0: no limit)")
+    args = parser.parse_args(argv)
+    server = DSServer(args.host, args.port, args.latency / 1000, args.history, args.senders, args.max_rate)
+    print("DS server emulator on %s:%d" % (args.host, args.port))
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
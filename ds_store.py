@@ -0,0 +1,392 @@
+# ds_store.py
+#
+# Local SQLite message store for the DS Direct Messenger
+#
+# The first sync for an account downloads the whole history with retrieve_all; every
+# sync after that only merges in the results of retrieve_new. Readers get conversations
+# out of the local database, so startup and refresh cost depends on new traffic and not
+# on the size of the whole history.
+
+import bisect
+import sqlite3
+import threading
+
+from ds_messenger import DirectMessage, DSUProtocolError, to_timestamp
+from ds_search import SearchIndex
+from ds_log import LOG
+
+
+class MessageStore:
+    """
+    The MessageStore class keeps the direct messages of one account in a SQLite database.
+
+    The database runs in WAL mode and has an index on (account, sender, timestamp), so
+    loading a single conversation is an index range scan. The same message is never stored
+    twice, which makes it safe to merge overlapping retrieve_all/retrieve_new results.
+    Message bodies can be searched; the word index is built in memory (keyed by row id),
+    on a background thread by build_search_index or else on the first search, and kept
+    up to date by add from then on.
+    """
+    def __init__(self, path:str, account:str):
+        """
+        Constructs all the necessary attributes for the MessageStore object.
+
+        :param path: database file (":memory:" for a throwaway store)
+        :param account: username whose messages are stored
+        :type path: str
+        :type account: str
+        """
+        self.path = path
+        self.account = account
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                account TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                message TEXT NOT NULL,
+                UNIQUE (account, sender, timestamp, message)
+            );
+            CREATE INDEX IF NOT EXISTS messages_sender_time
+                ON messages (account, sender, timestamp);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                account TEXT PRIMARY KEY,
+                full_sync INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        self._db.commit()
+        self._search = None
+        #guards the swap from _search_backlog to _search done by the index builder thread
+        self._search_lock = threading.Lock()
+        #(id, message) pairs stored while the index is being built (None when no build runs)
+        self._search_backlog = None
+        self._search_thread = None
+
+
+    def close(self) -> None:
+        """
+        Closes the database connection.
+        """
+        self._db.close()
+
+
+    def is_synced(self) -> bool:
+        """
+        Tells whether the full history of the account has been downloaded once.
+
+        :rtype: bool
+        """
+        row = self._db.execute("SELECT full_sync FROM sync_state WHERE account = ?",
+                               (self.account,)).fetchone()
+        return bool(row and row[0])
+
+
+    def sync(self, messenger) -> list:
+        """
+        Brings the store up to date with the DS server.
+
+        The first sync uses retrieve_all, later ones only retrieve_new. If the server call
+        fails nothing is changed and an empty list is returned.
+
+        :param messenger: DirectMessenger logged in as the store's account
+        :type messenger: DirectMessenger
+        :return: the DirectMessage objects that were not in the store yet
+        :rtype: list
+        """
+        if self.is_synced():
+            return self.add(messenger.retrieve_new() or [])
+        #the full history is streamed straight into the database instead of being
+        #materialised as one big response first (messages stored before a failure are
+        #kept; the next sync simply downloads everything again and skips them)
+        try:
+            added = self.add(messenger.iter_all())
+        except DSUProtocolError as dse:
+            LOG.warning(str(dse), op='sync')
+            return []
+        self.mark_synced()
+        return added
+
+
+    def mark_synced(self) -> None:
+        """
+        Records that the full history of the account has been downloaded, so later syncs
+        only ask for new messages.
+        """
+        self._db.execute("INSERT OR REPLACE INTO sync_state (account, full_sync) VALUES (?, 1)",
+                         (self.account,))
+        self._db.commit()
+
+
+    def add(self, messages) -> list:
+        """
+        Merges messages into the store, skipping ones it already holds.
+
+        :param messages: iterable of DirectMessage objects
+        :return: the DirectMessage objects that were actually added
+        :rtype: list
+        """
+        added = []
+        cur = self._db.cursor()
+        try:
+            for dm in messages:
+                cur.execute("INSERT OR IGNORE INTO messages (account, sender, timestamp, message) "
+                            "VALUES (?, ?, ?, ?)",
+                            (self.account, dm.get_recipient(), to_timestamp(dm.get_time()), dm.get_message()))
+                if cur.rowcount:
+                    added.append(dm)
+                    if self._search is not None or self._search_backlog is not None:
+                        self._index_added(cur.lastrowid, dm.get_message())
+        finally:
+            #keep what arrived if the messages iterator fails half way
+            self._db.commit()
+        return added
+
+
+    def conversation(self, user:str) -> list:
+        """
+        Returns every stored message from user, oldest first.
+
+        :param user: correspondent
+        :type user: str
+        :return: list of DirectMessage objects
+        :rtype: list
+        """
+        rows = self._db.execute("SELECT sender, timestamp, message FROM messages "
+                                "WHERE account = ? AND sender = ? ORDER BY timestamp",
+                                (self.account, user))
+        return [_to_message(row) for row in rows]
+
+
+    def messages(self) -> list:
+        """
+        Returns every stored message of the account, oldest first.
+
+        :return: list of DirectMessage objects
+        :rtype: list
+        """
+        rows = self._db.execute("SELECT sender, timestamp, message FROM messages "
+                                "WHERE account = ? ORDER BY timestamp", (self.account,))
+        return [_to_message(row) for row in rows]
+
+
+    def iter_messages(self, start:float = None, end:float = None):
+        """
+        Yields the stored messages of the account, oldest first, fetching rows as they
+        are consumed instead of building one big list.
+
+        :param start: only messages with timestamp >= start
+        :param end: only messages with timestamp < end
+        :type start: float
+        :type end: float
+        """
+        rows = self._db.execute("SELECT sender, timestamp, message FROM messages "
+                                "WHERE account = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+                                (self.account, float('-inf') if start is None else start,
+                                 float('inf') if end is None else end))
+        for row in rows:
+            yield _to_message(row)
+
+
+    def search(self, query:str, limit:int = 100) -> list:
+        """
+        Finds stored messages that contain every word of query.
+
+        :param query: words to look for (case does not matter)
+        :param limit: most messages to return (None returns every match)
+        :type query: str
+        :type limit: int
+        :return: list of DirectMessage objects, most recently stored first
+        :rtype: list
+        """
+        if self._search is None:
+            #without a finished index this blocks until one is built; see build_search_index
+            self.build_search_index(background=False)
+            if self._search_thread is not None:
+                self._search_thread.join()
+            if self._search is None:
+                return []
+        ids = self._search.search(query, limit)
+        if not ids:
+            return []
+        rows = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for row in self._db.execute("SELECT id, sender, timestamp, message FROM messages WHERE id IN (%s)"
+                                        % ','.join('?' * len(chunk)), chunk):
+                rows[row[0]] = row[1:]
+        return [_to_message(rows[row_id]) for row_id in ids if row_id in rows]
+
+
+    def build_search_index(self, background:bool = True) -> None:
+        """
+        Builds the word index used by search, unless it exists or is being built.
+
+        With background the rows are read and indexed by a separate thread on its own
+        connection, so the caller (e.g. the Tk thread) is not held up; messages added
+        meanwhile are indexed when the thread swaps the index in. search_ready tells
+        when it is done.
+
+        :param background: build on a separate thread (an in-memory store is always
+                           indexed right away, it cannot be opened a second time)
+        :type background: bool
+        """
+        with self._search_lock:
+            if self._search is not None or self._search_backlog is not None:
+                return
+            self._search_backlog = []
+            #rows up to here are read by the build, later ones arrive through add
+            last_id = self._db.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+        if not background or self.path == ':memory:':
+            self._build_search(self._db, last_id)
+            return
+        self._search_thread = threading.Thread(target=self._build_search_thread, args=(last_id,),
+                                               name='ds-search-index', daemon=True)
+        self._search_thread.start()
+
+
+    def search_ready(self) -> bool:
+        """
+        Tells whether search can answer without building the index first.
+
+        :rtype: bool
+        """
+        return self._search is not None
+
+
+    def search_building(self) -> bool:
+        """
+        Tells whether build_search_index is still running.
+
+        :rtype: bool
+        """
+        return self._search_backlog is not None
+
+
+    def _build_search_thread(self, last_id:int) -> None:
+        db = sqlite3.connect(self.path)
+        try:
+            self._build_search(db, last_id)
+        finally:
+            db.close()
+
+
+    def _build_search(self, db, last_id:int) -> None:
+        index = SearchIndex()
+        try:
+            index.add_many(db.execute("SELECT id, message FROM messages WHERE account = ? AND id <= ? "
+                                      "ORDER BY id", (self.account, last_id)))
+        except sqlite3.Error as e:
+            LOG.warning("could not build the search index", error=e)
+            with self._search_lock:
+                self._search_backlog = None
+            return
+        with self._search_lock:
+            index.add_many(self._search_backlog)
+            self._search_backlog = None
+            self._search = index
+
+
+    def _index_added(self, row_id:int, message:str) -> None:
+        with self._search_lock:
+            if self._search is not None:
+                self._search.add(row_id, message)
+            elif self._search_backlog is not None:
+                self._search_backlog.append((row_id, message))
+
+
+    def senders(self) -> list:
+        """
+        Returns everyone who has messaged the account, in order of their first message.
+
+        :return: list of usernames
+        :rtype: list
+        """
+        rows = self._db.execute("SELECT sender FROM messages WHERE account = ? "
+                                "GROUP BY sender ORDER BY MIN(timestamp)", (self.account,))
+        return [row[0] for row in rows]
+
+
+def _to_message(row) -> DirectMessage:
+    return DirectMessage(row[0], row[2], row[1])
+
+
+class ConversationIndex:
+    """
+    The ConversationIndex class groups messages by correspondent in memory.
+
+    Each correspondent maps to a timestamp-ordered list, so opening a conversation costs
+    time proportional to that conversation and not to the whole inbox. New messages are
+    merged in incrementally; a message newer than everything already held is a plain append.
+    """
+    def __init__(self, messages=()):
+        """
+        Constructs all the necessary attributes for the ConversationIndex object.
+
+        :param messages: iterable of DirectMessage objects to start with
+        """
+        self._conversations = {}
+        #timestamps as floats, parallel to the lists in _conversations (used for ordering)
+        self._times = {}
+        #correspondents in the order they were first seen
+        self._order = []
+        self.merge(messages)
+
+
+    def merge(self, messages) -> list:
+        """
+        Adds messages to the index.
+
+        :param messages: iterable of DirectMessage objects
+        :return: correspondents that were not in the index before, in first-seen order
+        :rtype: list
+        """
+        new_users = []
+        for dm in messages:
+            user = dm.get_recipient()
+            ts = to_timestamp(dm.get_time())
+            times = self._times.get(user)
+            if times is None:
+                self._conversations[user] = [dm]
+                self._times[user] = [ts]
+                self._order.append(user)
+                new_users.append(user)
+            elif ts >= times[-1]:
+                times.append(ts)
+                self._conversations[user].append(dm)
+            else:
+                i = bisect.bisect_right(times, ts)
+                times.insert(i, ts)
+                self._conversations[user].insert(i, dm)
+        return new_users
+
+
+    def conversation(self, user:str) -> list:
+        """
+        Returns the messages from user, oldest first.
+
+        :param user: correspondent
+        :type user: str
+        :return: list of DirectMessage objects (empty if user is unknown)
+        :rtype: list
+        """
+        return self._conversations.get(user, [])
+
+
+    def users(self) -> list:
+        """
+        Returns every correspondent in the order they were first seen.
+
+        :rtype: list
+        """
+        return list(self._order)
+
+
+    def __contains__(self, user) -> bool:
+        return user in self._conversations
+
+
+    def __len__(self) -> int:
+        return len(self._order)
@@ -0,0 +1,356 @@
+# ds_tkprofile.py
+#
+# Event-loop stall monitor and callback profiler for the Tk GUI
+#
+# UIMonitor measures how responsive the window is:
+#
+# - a heartbeat scheduled with root.after every `interval` seconds measures how late it
+#   runs, which is how long the event loop was busy (lag)
+# - every Tk callback (commands, bindings and after callbacks) is timed: tkinter wraps
+#   every Python callback in tkinter.CallWrapper, so install() swaps in a subclass that
+#   times the call before any widget is created. A callback that runs a nested event
+#   loop (e.g. wait_window for a modal dialog) is only charged for its own work, not for
+#   the time the nested loop spends waiting or running other callbacks
+# - a watchdog thread notices when the heartbeat is overdue by more than `threshold`
+#   and samples the stack of the Tk thread, so a slow callback is recorded with where
+#   it was spending its time
+#
+# stop() (also run at exit) writes a json report: lag percentiles, per-callback call
+# counts and latency, and the slowest calls with their sampled stacks.
+#
+# Opt-in: main.py starts it when DS_UI_PROFILE is set (to the report path, or 1 for
+# ds_ui_profile.json).
+#
+#     monitor = UIMonitor(report_path='ui.json').install()
+#     root = tk.Tk()
+#     monitor.start(root)
+#     ...
+#     root.mainloop()
+#     monitor.stop()
+
+import atexit
+import heapq
+import json
+import sys
+import threading
+import time
+import tkinter
+import traceback
+
+from ds_metrics import Histogram
+
+DEFAULT_REPORT = 'ds_ui_profile.json'
+
+
+class UIMonitor:
+    """
+    The UIMonitor class measures event-loop lag and the time spent in every Tk callback
+    of one process.
+    """
+    def __init__(self, interval:float = 0.05, threshold:float = 0.1, report_path:str = DEFAULT_REPORT,
+                 max_slow:int = 50, max_samples:int = 5, stack_depth:int = 20):
+        """
+        Constructs all the necessary attributes for the UIMonitor object.
+
+        :param interval: seconds between heartbeats
+        :param threshold: a callback or a stall longer than this (seconds) is recorded as slow
+        :param report_path: where stop writes the json report (None writes nothing)
+        :param max_slow: slowest calls kept for the report
+        :param max_samples: stacks sampled per slow call
+        :param stack_depth: innermost frames kept of each sampled stack
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.report_path = report_path
+        self.max_slow = max_slow
+        self.max_samples = max_samples
+        self.stack_depth = stack_depth
+        self._lock = threading.Lock()
+        self.lag = Histogram()
+        self.max_lag = 0.0
+        self.stalls = 0
+        #callback name -> [Histogram, slowest call in seconds, calls over threshold]
+        self.callbacks = {}
+        #(seconds, n, entry) min-heap of the slowest calls
+        self._slow = []
+        self._slow_n = 0
+        #callbacks running right now on the Tk thread, innermost last:
+        #[name, start of the current stretch (None while a nested callback runs), stacks,
+        # seconds counted so far, ran a nested event loop]
+        self._running = []
+        self._root = None
+        self._tk_thread = None
+        self._expected = None
+        self._last_beat = None
+        self._after_id = None
+        self._stop = threading.Event()
+        self._watchdog = None
+        self._original = None
+        self._started = None
+        self._stopped = False
+
+
+    def install(self) -> 'UIMonitor':
+        """
+        Starts timing Tk callbacks. Only callbacks registered after this are timed, so
+        call it before the widgets are created.
+
+        :return: self
+        :rtype: UIMonitor
+        """
+        if self._original is None:
+            self._original = tkinter.CallWrapper
+            tkinter.CallWrapper = _timed_wrapper(self, self._original)
+        return self
+
+
+    def uninstall(self) -> None:
+        if self._original is not None:
+            tkinter.CallWrapper = self._original
+            self._original = None
+
+
+    def start(self, root) -> 'UIMonitor':
+        """
+        Starts the heartbeat on root and the watchdog thread, and arranges for stop to
+        run at exit. Call from the Tk thread.
+
+        :param root: the Tk root window
+        :return: self
+        :rtype: UIMonitor
+        """
+        self.install()
+        self._root = root
+        self._tk_thread = threading.get_ident()
+        self._started = self._last_beat = time.perf_counter()
+        self._expected = self._started + self.interval
+        self._after_id = root.after(int(self.interval * 1000), self._beat)
+        self._watchdog = threading.Thread(target=self._watch, name='ds-ui-watchdog', daemon=True)
+        self._watchdog.start()
+        atexit.register(self.stop)
+        return self
+
+
+    def stop(self) -> dict:
+        """
+        Stops measuring and writes the report to report_path. Safe to call twice.
+
+        :return: the report
+        :rtype: dict
+        """
+        if self._stopped:
+            return self.report()
+        self._stopped = True
+        self._stop.set()
+        if self._root is not None and self._after_id is not None:
+            try:
+                self._root.after_cancel(self._after_id)
+            except (tkinter.TclError, RuntimeError):
+                #the window is already gone
+                pass
+        self.uninstall()
+        report = self.report()
+        if self.report_path:
+            with open(self.report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+
+
+    def report(self) -> dict:
+        """
+        Returns what was measured so far.
+
+        :return: lag (heartbeat lateness percentiles in ms), stalls (heartbeats later
+                 than threshold), callbacks (per name: calls, total/mean/p95/max ms and
+                 slow count, busiest first) and slow (the slowest calls with sampled stacks;
+                 nested_loop marks a call that ran a nested event loop)
+        :rtype: dict
+        """
+        with self._lock:
+            callbacks = {}
+            for name, (hist, longest, slow) in sorted(self.callbacks.items(), key=lambda item: -item[1][0].sum):
+                callbacks[name] = {
+                    'calls': hist.count,
+                    'total_ms': _ms(hist.sum),
+                    'mean_ms': _ms(hist.sum / hist.count),
+                    #bucket interpolation can overshoot the largest value seen
+                    'p95_ms': _ms(min(hist.percentile(95), longest)),
+                    'max_ms': _ms(longest),
+                    'slow': slow,
+                    }
+            slow = [entry for _, _, entry in sorted(self._slow, key=lambda item: -item[0])]
+            return {
+                'duration': round(time.perf_counter() - self._started, 3) if self._started else 0.0,
+                'interval_ms': _ms(self.interval),
+                'threshold_ms': _ms(self.threshold),
+                'lag': {
+                    'beats': self.lag.count,
+                    'mean_ms': _ms(self.lag.sum / self.lag.count) if self.lag.count else None,
+                    'p50_ms': _ms(_capped(self.lag.percentile(50), self.max_lag)),
+                    'p95_ms': _ms(_capped(self.lag.percentile(95), self.max_lag)),
+                    'p99_ms': _ms(_capped(self.lag.percentile(99), self.max_lag)),
+                    'max_ms': _ms(self.max_lag),
+                    },
+                'stalls': self.stalls,
+                'callbacks': callbacks,
+                'slow': slow,
+                }
+
+
+    def _beat(self) -> None:
+        now = time.perf_counter()
+        lag = max(0.0, now - self._expected)
+        with self._lock:
+            self.lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.stalls += 1
+        self._last_beat = now
+        self._expected = now + self.interval
+        if not self._stopped:
+            self._after_id = self._root.after(int(self.interval * 1000), self._beat)
+
+
+    def _watch(self) -> None:
+        #samples the Tk thread's stack while the heartbeat is overdue
+        frames = sys._current_frames
+        last_sample = 0.0
+        #(heartbeat it followed, report entry) of the last stall outside a callback
+        stall = None
+        while not self._stop.wait(self.threshold / 2):
+            now = time.perf_counter()
+            if now - self._last_beat < self.interval + self.threshold or now - last_sample < self.threshold:
+                continue
+            frame = frames().get(self._tk_thread)
+            if frame is None:
+                continue
+            last_sample = now
+            stack = [line.rstrip('\n') for line in traceback.format_stack(frame, self.stack_depth)]
+            with self._lock:
+                if self._running:
+                    samples = self._running[-1][2]
+                    if len(samples) < self.max_samples:
+                        samples.append(stack)
+                elif stall is not None and stall[0] == self._last_beat:
+                    #the same stall as last time: only the sample and its length are added
+                    if len(stall[1]['stacks']) < self.max_samples:
+                        stall[1]['stacks'].append(stack)
+                    stall[1]['ms'] = _ms(now - self._last_beat)
+                else:
+                    #busy outside any Python callback (inside Tk, or before mainloop runs)
+                    stall = (self._last_beat, {'callback': None, 'ms': _ms(now - self._last_beat),
+                                               'at': time.time(), 'stacks': [stack]})
+                    self._add_slow(stall[1], now - self._last_beat)
+
+
+    def _enter(self, name:str) -> list:
+        now = time.perf_counter()
+        call = [name, now, [], 0.0, False]
+        with self._lock:
+            if self._running:
+                _pause(self._running[-1], now)
+            self._running.append(call)
+        return call
+
+
+    def _leave(self, call:list) -> None:
+        now = time.perf_counter()
+        name = call[0]
+        with self._lock:
+            self._running.remove(call)
+            elapsed = call[3] + (now - call[1])
+            if self._running:
+                #the callback that ran the nested event loop gets the clock back
+                self._running[-1][1] = now
+            stats = self.callbacks.get(name)
+            if stats is None:
+                stats = self.callbacks[name] = [Histogram(), 0.0, 0]
+            stats[0].observe(elapsed)
+            stats[1] = max(stats[1], elapsed)
+            if elapsed > self.threshold:
+                stats[2] += 1
+                entry = {'callback': name, 'ms': _ms(elapsed), 'at': time.time(), 'stacks': call[2]}
+                if call[4]:
+                    entry['nested_loop'] = True
+                self._add_slow(entry, elapsed)
+
+
+    def _tick(self) -> None:
+        #an uncounted callback (the heartbeat) ran: if it ran inside a callback, that
+        #callback is waiting in a nested event loop and the wait is not its own time
+        with self._lock:
+            if self._running:
+                now = time.perf_counter()
+                _pause(self._running[-1], now)
+                self._running[-1][1] = now
+
+
+    def _add_slow(self, entry:dict, seconds:float) -> None:
+        #keeps the max_slow slowest; callers hold self._lock
+        self._slow_n += 1
+        item = (seconds, self._slow_n, entry)
+        if len(self._slow) < self.max_slow:
+            heapq.heappush(self._slow, item)
+        elif seconds > self._slow[0][0]:
+            heapq.heapreplace(self._slow, item)
+
+
+def _pause(call:list, now:float) -> None:
+    #another callback starts inside call, so call is running a nested event loop (e.g.
+    #wait_window). Up to the first one its time is its own; after that the gaps between
+    #nested callbacks are the loop waiting for events and are left out
+    if call[1] is not None and not call[4]:
+        call[3] += now - call[1]
+    call[1] = None
+    call[4] = True
+
+
+def _timed_wrapper(monitor:UIMonitor, base):
+    class TimedCallWrapper(base):
+        """
+        tkinter.CallWrapper that reports how long each call takes to monitor.
+        """
+        def __init__(self, func, subst, widget):
+            super().__init__(func, subst, widget)
+            self.name = callback_name(func)
+            #the heartbeat itself is not a callback worth profiling
+            self.timed = self.name != UIMonitor._beat.__qualname__
+
+        def __call__(self, *args):
+            if monitor._stopped:
+                return super().__call__(*args)
+            if not self.timed:
+                monitor._tick()
+                return super().__call__(*args)
+            call = monitor._enter(self.name)
+            try:
+                return super().__call__(*args)
+            finally:
+                monitor._leave(call)
+    return TimedCallWrapper
+
+
+def callback_name(func) -> str:
+    """
+    Names a Tk callback by the qualified name of the function Tk calls, e.g.
+    "Body.node_select". That is the function given to command=, bind or after, so the
+    send button is reported as "Footer.send_click" although it goes on to call
+    MainApp.send_message.
+
+    root.after wraps its callback in a local function; the callback inside is named.
+
+    :rtype: str
+    """
+    if getattr(func, '__qualname__', '').endswith('.<locals>.callit') and func.__closure__:
+        cells = dict(zip(func.__code__.co_freevars, func.__closure__))
+        if 'func' in cells:
+            func = cells['func'].cell_contents
+    return getattr(func, '__qualname__', None) or getattr(func, '__name__', None) or repr(func)
+
+
+def _ms(seconds) -> float:
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def _capped(value, limit):
+    return None if value is None else min(value, limit)
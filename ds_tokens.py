@@ -0,0 +1,114 @@
+# ds_tokens.py
+#
+# On-disk cache of DS server tokens
+#
+# Lets a client reuse the token from its last join instead of joining again on every
+# start. Entries are keyed by server, port and username and hold nothing but the token
+# (no password or hash of it): the file is created readable and writable by its owner
+# only, and the server turns down a token that is no longer valid, after which the
+# client joins with its password as usual.
+#
+# Opt-in: from_env returns a cache only when DS_TOKEN_CACHE is set (to the cache file,
+# or 1 for ~/.ds_token_cache.json).
+
+import json
+import os
+import threading
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.ds_token_cache.json')
+
+
+class TokenCache:
+    """
+    The TokenCache class stores the last token per (server, port, username) in a json file.
+
+    Callers use get before joining and put after a successful join; when the server
+    rejects a cached token they join again and put the new one.
+    """
+    def __init__(self, path:str = None):
+        """
+        Constructs all the necessary attributes for the TokenCache object.
+
+        :param path: cache file (defaults to ~/.ds_token_cache.json)
+        :type path: str
+        """
+        self.path = path or DEFAULT_PATH
+        self._lock = threading.Lock()
+        self._entries = None
+
+
+    def get(self, server:str, port:int, username:str) -> str:
+        """
+        Returns the cached token for the account, or None if there is none.
+
+        :rtype: str
+        """
+        with self._lock:
+            entry = self._load().get(_key(server, port, username))
+        return entry.get('token') if isinstance(entry, dict) else None
+
+
+    def put(self, server:str, port:int, username:str, token:str) -> None:
+        """
+        Remembers token as the current token of the account.
+        """
+        with self._lock:
+            entries = self._load()
+            key = _key(server, port, username)
+            if entries.get(key) == {'token': token}:
+                #the server usually hands out the same token again; nothing to write
+                return
+            entries[key] = {'token': token}
+            self._save(entries)
+
+
+    def forget(self, server:str, port:int, username:str) -> None:
+        """
+        Drops the cached token of the account.
+        """
+        with self._lock:
+            entries = self._load()
+            if entries.pop(_key(server, port, username), None) is not None:
+                self._save(entries)
+
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+            if not isinstance(self._entries, dict):
+                self._entries = {}
+        return self._entries
+
+
+    def _save(self, entries:dict) -> None:
+        tmp = self.path + '.tmp'
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, self.path)
+        except OSError:
+            #the cache only saves a round trip, so failing to write it is not fatal
+            pass
+
+
+def _key(server:str, port:int, username:str) -> str:
+    return '%s:%s:%s' % (server, port, username)
+
+
+def from_env():
+    """
+    Returns the TokenCache asked for by DS_TOKEN_CACHE (a cache file, or 1 for the
+    default one), or None when it is not set.
+
+    :rtype: TokenCache
+    """
+    path = os.environ.get('DS_TOKEN_CACHE')
+    if not path or path == '0':
+        return None
+    return TokenCache(None if path == '1' else path)
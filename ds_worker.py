@@ -0,0 +1,222 @@
+# ds_worker.py
+#
+# Background network worker for the DS Direct Messenger GUI
+#
+# All socket I/O happens on one worker thread that owns the DirectMessenger. The Tk
+# thread only puts jobs on a queue and drains a result queue (with root.after), so a
+# slow server never freezes the window.
+
+import queue
+import threading
+import time
+
+from ds_messenger import DSUProtocolError
+
+
+class PollingWorker:
+    """
+    The PollingWorker class runs retrieve_new on an adaptive interval and performs sends
+    off the UI thread.
+
+    The interval drops back to min_interval whenever new messages arrive or something is
+    sent, and doubles (up to max_interval) after every poll that brought nothing new.
+    Results are put on the results queue as tuples:
+
+    - ("new", messages): list of DirectMessage objects from retrieve_new (or one batch
+      of the full history)
+    - ("synced", full): the first fetch after start, or after an error, succeeded; full
+      is true when it downloaded the whole history
+    - ("sent", message, recipient, ok, error): outcome of a send; error is the reason it
+      failed (None when ok), so nobody has to ask the messenger from another thread
+    - ("error", text): a poll failed, outbox messages are waiting for the server, or a
+      job raised an unexpected exception (the worker keeps running)
+
+    The first poll runs as soon as the worker starts. With full_sync the whole history
+    is streamed with iter_all and reported batch_size messages at a time (until that
+    succeeds once); after that only retrieve_new is used.
+
+    With an outbox, send only appends to it; the worker delivers the outbox in batches
+    and, after a failed delivery, tries again with exponential backoff (min_interval
+    doubling up to max_interval) instead of reporting the messages as failed.
+    """
+    def __init__(self, messenger, min_interval:float = 2.0, max_interval:float = 30.0, outbox=None,
+                 full_sync:bool = False, batch_size:int = 5000):
+        """
+        Constructs all the necessary attributes for the PollingWorker object.
+
+        :param messenger: DirectMessenger used only by the worker thread once started
+        :param min_interval: shortest time between polls in seconds
+        :param max_interval: longest time between polls in seconds
+        :param outbox: durable outbox for sends (optional)
+        :param full_sync: download the whole history before polling for new messages
+        :param batch_size: messages per "new" result during the full download
+        :type messenger: DirectMessenger
+        :type min_interval: float
+        :type max_interval: float
+        :type outbox: ds_outbox.Outbox
+        :type full_sync: bool
+        :type batch_size: int
+        """
+        self.messenger = messenger
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.outbox = outbox
+        self.full_sync = full_sync
+        self.batch_size = batch_size
+        self._online = False
+        self._retry_at = 0.0
+        self._retry_delay = min_interval
+        self.results = queue.Queue()
+        self._jobs = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ds-poller', daemon=True)
+
+
+    def start(self) -> None:
+        """
+        Starts the worker thread. The first poll is done right away.
+        """
+        self._jobs.put(('poll',))
+        self._thread.start()
+
+
+    def stop(self, timeout:float = None) -> None:
+        """
+        Asks the worker thread to finish and waits for it.
+
+        :param timeout: longest time to wait in seconds (None waits until it is done)
+        :type timeout: float
+        """
+        self._stopped.set()
+        self._jobs.put(None)
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+
+    def send(self, message:str, recipient:str) -> None:
+        """
+        Queues a message to be sent; the outcome shows up on the results queue.
+
+        :param message: message wanting to be sent
+        :param recipient: person you are sending the message to
+        :type message: str
+        :type recipient: str
+        """
+        if self.outbox is not None:
+            #on disk before this returns; the worker thread delivers it
+            self.outbox.add(message, recipient)
+            self._jobs.put(('flush',))
+        else:
+            self._jobs.put(('send', message, recipient))
+
+
+    def poll_now(self) -> None:
+        """
+        Makes the worker poll right away instead of waiting for the interval.
+        """
+        self._jobs.put(('poll',))
+
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            timeout = self.interval
+            if self.outbox is not None and len(self.outbox):
+                timeout = max(0.0, min(timeout, self._retry_at - time.monotonic()))
+            try:
+                job = self._jobs.get(timeout=timeout)
+            except queue.Empty:
+                job = ('poll',) if timeout == self.interval else ('flush',)
+            if job is None or self._stopped.is_set():
+                break
+            try:
+                self._do(job)
+            except Exception as exc:
+                #an unexpected failure must not end the thread: report it and keep polling
+                self._failed(str(exc) or type(exc).__name__)
+                self.interval = min(self.interval * 2, self.max_interval)
+                if self.outbox is not None:
+                    self._retry_at = time.monotonic() + self._retry_delay
+                    self._retry_delay = min(self._retry_delay * 2, self.max_interval)
+        if hasattr(self.messenger, 'close'):
+            self.messenger.close()
+
+
+    def _do(self, job:tuple) -> None:
+        if job[0] == 'send':
+            ok = bool(self.messenger.send(job[1], job[2]))
+            error = None if ok else getattr(self.messenger, 'last_error', None) or 'could not reach the DS server'
+            self.results.put(('sent', job[1], job[2], ok, error))
+            #a reply is likely soon after we send something
+            self.interval = self.min_interval
+        elif job[0] == 'poll':
+            self._poll()
+        if self.outbox is not None and len(self.outbox) and time.monotonic() >= self._retry_at:
+            self._flush()
+
+
+    def _poll(self) -> None:
+        if self.full_sync:
+            self._sync_all()
+            return
+        messages = self.messenger.retrieve_new()
+        if messages is None:
+            self._failed('could not retrieve new messages')
+            self.interval = min(self.interval * 2, self.max_interval)
+            return
+        if messages:
+            self.results.put(('new', messages))
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        self._succeeded(False)
+
+
+    def _sync_all(self) -> None:
+        #streams the history so the first batches show up before the download ends
+        batch = []
+        try:
+            for dm in self.messenger.iter_all():
+                batch.append(dm)
+                if len(batch) >= self.batch_size:
+                    self.results.put(('new', batch))
+                    batch = []
+        except DSUProtocolError as dse:
+            if batch:
+                self.results.put(('new', batch))
+            self._failed(str(dse))
+            self.interval = min(self.interval * 2, self.max_interval)
+            return
+        if batch:
+            self.results.put(('new', batch))
+        self.full_sync = False
+        self.interval = self.min_interval
+        self._succeeded(True)
+
+
+    def _succeeded(self, full:bool) -> None:
+        if full or not self._online:
+            self._online = True
+            self.results.put(('synced', full))
+
+
+    def _failed(self, text:str) -> None:
+        self._online = False
+        self.results.put(('error', text))
+
+
+    def _flush(self) -> None:
+        delivered, rejected, complete = self.outbox.flush(self.messenger)
+        for dm in delivered:
+            self.results.put(('sent', dm.get_message(), dm.get_recipient(), True, None))
+        for dm, error in rejected:
+            self.results.put(('sent', dm.get_message(), dm.get_recipient(), False, error))
+        if delivered:
+            self.interval = self.min_interval
+        if complete:
+            self._retry_at = 0.0
+            self._retry_delay = self.min_interval
+        else:
+            self._retry_at = time.monotonic() + self._retry_delay
+            self._retry_delay = min(self._retry_delay * 2, self.max_interval)
+            self._failed('%d messages waiting in the outbox' % len(self.outbox))
@@ -6,9 +6,29 @@
 # Authors: Carlos Lim, Jun Zhu
 # 17 March 2021
 
+import os
+import queue
+import time
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-from ds_messenger import *
+from ds_messenger import DirectMessenger, DSUProtocolError
+from ds_store import MessageStore, ConversationIndex
+from ds_worker import PollingWorker
+import ds_tokens
+from ds_outbox import Outbox
+from ds_log import LOG
+from collections import deque
+
+#messages inserted into the message_frame per idle tick / per page of scrolling
+PAGE_SIZE = 500
+#most messages kept in the message_frame at once; the rest are loaded while scrolling
+WINDOW_SIZE = 2000
+#most matches listed by a search
+SEARCH_LIMIT = 200
+#ms between checks while the search index is being built
+SEARCH_RETRY = 200
+#longest time (seconds) spent merging worker results per call of _drain_results
+DRAIN_BUDGET = 0.05
 
 
 class Body(tk.Frame):
@@ -16,26 +36,44 @@ class Body(tk.Frame):
     A subclass of tk.Frame that is responsible for drawing all of the widgets
     in the body portion of the root frame.
     """
-    def __init__(self, root, directMessenger=None):
+    def __init__(self, root, directMessenger=None, store=None):
         """
         Constructs all the necessary attributes for Body object.
 
         :param root: tk.Menu
         :param directMessenger: DirectMessenger object created by MainApp
+        :param store: local MessageStore created by MainApp
         :type root: tk.main.root
         :type directMessenger: DirectMessenger object
+        :type store: MessageStore object
         """
         tk.Frame.__init__(self, root)
         self.root = root
         self.directMessenger = directMessenger
+        self.store = store
         #determines if there is a sender (uses to send message)
         self.sender = None
-        #retrieves all the messages
-        self.messages = self.directMessenger.retrieve_all()
-        #list of users to populate the tree
+        #messages grouped by user, so a conversation opens without scanning the inbox;
+        #a user's messages are read from the store the first time they are opened
+        self.index = ConversationIndex()
+        #list of users to populate the tree (and a set for quick membership checks)
         self._users = []
+        self._user_set = set()
+        #the open conversation, the slice [_first, _last) of it shown in message_frame,
+        #the number of text lines each shown message takes, the pending render job and
+        #the pending page load queued by scrolling
+        self._conversation = []
+        self._first = 0
+        self._last = 0
+        self._line_counts = deque()
+        self._render_job = None
+        self._scroll_job = None
+        #search waiting for the background index build
+        self._search_job = None
         self._draw()
-        self.set_users()
+        self.set_status("Loading messages...")
+        #the window is drawn first; saved users are filled in on the first idle tick
+        self.after_idle(self.set_users)
 
 
     def node_select(self, event) -> None:
@@ -45,40 +83,209 @@ class Body(tk.Frame):
 
         :param event: not used
         """
-        #adds new messages received every time a user clicks on another user (kind of like a refresh)
-        if self.messages != self.messages + self.directMessenger.retrieve_new():
-            self.messages = self.directMessenger.retrieve_all()
-            print('retrieving new...')
-    
         if self.user_tree.selection():
             #selections are not 0-based, so subtarct one.
             index = int(self.user_tree.selection()[0])-1
+            if self._users[index] == self.sender:
+                #already open (and kept up to date by add_messages)
+                return
             self.sender = self._users[index]
             #empties the main message frame for senders messages (via populate_msg)
             self.reset_main()
             self.populate_msg(self.sender)
 
-    def populate_msg(self, user:str) -> None:
+
+    def search_messages(self, event=None) -> None:
         """
-        Populates the messages_frame with all the messages from that user.
+        Searches the stored messages for the words in search_entry and lists the
+        matches in a searchWindow.
 
-        :param user: person clicked on by node_select
+        :param event: not used
+        """
+        query = self.search_entry.get().strip()
+        if query == "":
+            return
+        if self.store.search_building():
+            #the index is still being built in the background; ask again once it is there
+            self.set_status("Preparing search...")
+            if self._search_job is None:
+                self._search_job = self.after(SEARCH_RETRY, self._retry_search)
+            return
+        results = self.store.search(query, SEARCH_LIMIT)
+        searchWindow(self.root, query, results, self.open_conversation)
+
+
+    def _retry_search(self) -> None:
+        self._search_job = None
+        if not self.store.search_building():
+            self.set_status(None)
+        self.search_messages()
+
+
+    def open_conversation(self, user:str) -> None:
+        """
+        Selects user in the user_tree, which opens their messages (via node_select).
+
+        :param user: correspondent to show
         :type user: str
         """
-        #adopted from stackoverflow (check README for citation)
-        #configures message_frame to 'normal' so we can edit the Text frame
+        if user not in self._user_set:
+            self.insert_user(user)
+        node = str(self._users.index(user) + 1)
+        self.user_tree.selection_set(node)
+        self.user_tree.see(node)
+
+
+    def add_messages(self, messages:list) -> None:
+        """
+        Merges messages fetched by the background worker into the store, the index,
+        the user_tree and (if it is open) the current conversation.
+
+        :param messages: DirectMessage objects from retrieve_new
+        :type messages: list
+        """
+        new_messages = self.store.add(messages)
+        if not new_messages:
+            return
+        #conversations that were never opened are read from the store when they are
+        self.index.merge(dm for dm in new_messages if dm.get_recipient() in self.index)
+        for dm in new_messages:
+            if dm.get_recipient() not in self._user_set:
+                self.insert_user(dm.get_recipient())
+        if self.sender is not None and self.sender not in self.index:
+            #first messages from a user who was added by hand
+            self.index.merge(self.store.conversation(self.sender))
+            self._conversation = self.index.conversation(self.sender)
+        if self.sender is not None and self._render_job is None:
+            #only appends what is new to the open conversation
+            self._load_later()
+
+
+    def _render_next(self) -> None:
+        """
+        Inserts the next page of the open conversation, then schedules itself on the
+        next idle tick until the shown slice reaches the newest message.
+        """
+        self._render_job = None
+        if self._last < len(self._conversation):
+            self._append(self._conversation[self._last:self._last + PAGE_SIZE])
+            self._render_job = self.after_idle(self._render_next)
+        else:
+            self.message_frame.see('end')
+
+
+    def _append(self, messages:list) -> None:
+        """
+        Appends messages below the shown slice.
+        """
+        text = ''.join(dm1.get_message() + '\n' for dm1 in messages)
         self.message_frame.configure(state='normal')
-        
-        for dm1 in self.messages:
-            if dm1.get_recipient() == user:
-                self.message_frame.insert('end', dm1.get_message() + '\n')
+        self.message_frame.insert('end-1c', text)
         self.message_frame.configure(state='disabled')
+        self._line_counts.extend(dm1.get_message().count('\n') + 1 for dm1 in messages)
+        self._last += len(messages)
+
+
+    def _load_earlier(self) -> None:
+        """
+        Shows the page before the shown slice (the user scrolled to the top) and drops
+        messages from the bottom to keep at most WINDOW_SIZE in the widget.
+        """
+        if self._first == 0 or self._render_job is not None:
+            return
+        start = max(0, self._first - PAGE_SIZE)
+        messages = self._conversation[start:self._first]
+        text = ''.join(dm1.get_message() + '\n' for dm1 in messages)
+        counts = [dm1.get_message().count('\n') + 1 for dm1 in messages]
+        self.message_frame.configure(state='normal')
+        self.message_frame.insert('1.0', text)
+        self._line_counts.extendleft(reversed(counts))
+        self._first = start
+        excess = len(self._line_counts) - WINDOW_SIZE
+        if excess > 0:
+            for _ in range(excess):
+                self._line_counts.pop()
+            total = sum(self._line_counts)
+            self.message_frame.delete('%d.0' % (total + 1), 'end-1c')
+            self._last -= excess
+        self.message_frame.configure(state='disabled')
+        #keeps the line the user was looking at in place
+        self.message_frame.yview('%d.0' % (sum(counts) + 1))
+
+
+    def _load_later(self) -> None:
+        """
+        Shows the messages after the shown slice (the user scrolled to the bottom or new
+        messages arrived) and drops messages from the top to keep at most WINDOW_SIZE.
+        """
+        if self._last >= len(self._conversation):
+            return
+        at_bottom = self.message_frame.yview()[1] >= 1.0
+        self._append(self._conversation[self._last:self._last + PAGE_SIZE])
+        excess = len(self._line_counts) - WINDOW_SIZE
+        if excess > 0:
+            lines = sum(self._line_counts.popleft() for _ in range(excess))
+            self.message_frame.configure(state='normal')
+            self.message_frame.delete('1.0', '%d.0' % (lines + 1))
+            self.message_frame.configure(state='disabled')
+            self._first += excess
+        if at_bottom:
+            self.message_frame.see('end')
+
+
+    def _on_message_scroll(self, first, last) -> None:
+        """
+        yscrollcommand of message_frame: moves the scrollbar and loads the next page
+        when the user reaches either end of the shown slice.
+        """
+        self.message_scrollbar.set(first, last)
+        #every scroll step calls this; one queued page load is enough
+        if self._render_job is not None or self._scroll_job is not None:
+            return
+        if float(first) <= 0.0 and self._first > 0:
+            self._scroll_job = self.after_idle(self._load_page, self._load_earlier)
+        elif float(last) >= 1.0 and self._last < len(self._conversation):
+            self._scroll_job = self.after_idle(self._load_page, self._load_later)
+
+
+    def _load_page(self, load) -> None:
+        self._scroll_job = None
+        load()
+
+
+    def populate_msg(self, user:str) -> None:
+        """
+        Populates the messages_frame with the newest WINDOW_SIZE messages from that user.
+        They are inserted PAGE_SIZE at a time on idle ticks, so a long conversation never
+        blocks the window; older messages are loaded when the user scrolls up.
+
+        :param user: person clicked on by node_select
+        :type user: str
+        """
+        if user not in self.index:
+            self.index.merge(self.store.conversation(user))
+        #the index hands out its live list, so messages merged later show up in it
+        self._conversation = self.index.conversation(user)
+        self._first = self._last = max(0, len(self._conversation) - WINDOW_SIZE)
+        self._line_counts.clear()
+        self._render_next()
 
 
     def reset_main(self) -> None:
         """
         Resets the main_frame for another user's direct messages.
         """
+        if self._render_job is not None:
+            self.after_cancel(self._render_job)
+            self._render_job = None
+        if self._scroll_job is not None:
+            self.after_cancel(self._scroll_job)
+            self._scroll_job = None
+        self._conversation = []
+        self._first = self._last = 0
+        self._line_counts.clear()
+        #adopted from stackoverflow (check README for citation)
+        #configures message_frame to 'normal' so we can edit the Text frame
         self.message_frame.configure(state='normal')
         #deletes all the text in the message_frame
         self.message_frame.delete('1.0', 'end')
@@ -110,11 +317,25 @@ class Body(tk.Frame):
 
     def set_users(self) -> None:
         """
-        Sets the user into the user_tree.
+        Sets the users saved in the store into the user_tree.
         """
-        for dm in self.messages:
-            if dm.get_recipient() not in self._users:
-                self.insert_user(dm.get_recipient())
+        for user in self.store.senders():
+            if user not in self._user_set:
+                self.insert_user(user)
+
+
+    def set_status(self, text:str = None) -> None:
+        """
+        Shows text under the user_tree (e.g. while loading), or hides it.
+
+        :param text: status to show, None to hide it
+        :type text: str
+        """
+        if text is None:
+            self.status.pack_forget()
+        else:
+            self.status.configure(text=text)
+            self.status.pack(fill=tk.X, side=tk.BOTTOM, padx=5, before=self.user_tree)
 
 
     def insert_user(self, user:str) -> None:
@@ -125,6 +346,7 @@ class Body(tk.Frame):
         :type user: str
         """
         self._users.append(user)
+        self._user_set.add(user)
         self._insert_user_tree(len(self._users), user)
 
         
@@ -151,7 +373,13 @@ class Body(tk.Frame):
         """
         users_frame = tk.Frame(master=self, width=250)
         users_frame.pack(fill=tk.BOTH, side=tk.LEFT)
+        #search box (press Enter to search every stored message)
+        self.search_entry = tk.Entry(users_frame)
+        self.search_entry.bind("<Return>", self.search_messages)
+        self.search_entry.pack(fill=tk.X, side=tk.TOP, padx=5, pady=(5, 0))
         #Tree widget
+        #loading indicator (see set_status)
+        self.status = tk.Label(users_frame, anchor='w')
         self.user_tree = ttk.Treeview(users_frame)
         self.user_tree.bind("<<TreeviewSelect>>", self.node_select)
         self.user_tree.pack(fill=tk.BOTH, side=tk.TOP, expand=True, padx=5, pady=5)
@@ -183,8 +411,8 @@ class Body(tk.Frame):
         self.entry_editor['yscrollcommand'] = entry_editor_scrollbar.set
         entry_editor_scrollbar.pack(fill=tk.Y, side=tk.LEFT, expand=False, padx=0, pady=0)
 
-        message_scrollbar = tk.Scrollbar(master=scroll_frame2, command=self.message_frame.yview)
-        self.message_frame['yscrollcommand'] = message_scrollbar.set
+        message_scrollbar = self.message_scrollbar = tk.Scrollbar(master=scroll_frame2, command=self.message_frame.yview)
+        self.message_frame['yscrollcommand'] = self._on_message_scroll
         message_scrollbar.pack(fill=tk.Y, side=tk.LEFT, expand=False, padx=0, pady=0)
     
 
@@ -278,6 +506,47 @@ class popupWindow:
         self.window.destroy()
         
 
+class searchWindow:
+    """
+    The searchWindow class generates a Toplevel pop-up window listing the messages
+    that matched a search. Double clicking a match opens that conversation.
+    """
+    def __init__(self, root, query:str, results:list, open_callback=None):
+        """
+        Constructs all the necessary attributes for searchWindow object
+
+        :param root: master root from MainApp
+        :param query: the words that were searched for
+        :param results: matching DirectMessage objects
+        :param open_callback: called with the sender of a double clicked match
+        :type root: tk.main.root
+        :type query: str
+        :type results: list
+        :type open_callback: function
+        """
+        window = self.window = tk.Toplevel(root)
+        window.title('Search: ' + query)
+        self._results = results
+        self._open_callback = open_callback
+        self.l = tk.Label(window, text="%d matches" % len(results) if results else "No matches")
+        self.l.pack()
+        self.list = tk.Listbox(window, width=60, height=15)
+        for dm in results:
+            #one line per match, newlines in the message are shown as spaces
+            self.list.insert('end', dm.get_recipient() + ': ' + ' '.join(dm.get_message().split()))
+        self.list.bind("<Double-Button-1>", self.open_click)
+        self.list.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+
+    def open_click(self, event=None) -> None:
+        """
+        Opens the conversation of the selected match.
+        """
+        selection = self.list.curselection()
+        if selection and self._open_callback is not None:
+            self._open_callback(self._results[selection[0]].get_recipient())
+
+
 class MainApp(tk.Frame):
     """
     A subclass of tk.Frame that is responsible for drawing all of the widgets
@@ -291,15 +560,29 @@ class MainApp(tk.Frame):
         """
         tk.Frame.__init__(self, root)
         self.root = root
-        #ensure that person is able to connect before packing (drawing all the widgets)
+        #the window is drawn from the local store; the worker talks to the server
         try:
-            self.dm = DirectMessenger('168.235.86.101', 'abigail9009', '123')
+            #the token is only cached on disk when DS_TOKEN_CACHE asks for it
+            self.dm = DirectMessenger('168.235.86.101', 'abigail9009', '123', keep_alive=True,
+                                     token_cache=ds_tokens.from_env())
+            self.store = MessageStore('ds_messages.db', self.dm.username)
+            #the search index is built off the Tk thread so the first search does not freeze the window
+            self.store.build_search_index()
             self._draw()
+            #from here on only the worker thread touches self.dm
+            #sends are kept on disk until the server has them, so none are lost offline
+            self.outbox = Outbox('ds_outbox_' + self.dm.username + '.log')
+            #the whole history is downloaded (in the background) only the first time
+            self.worker = PollingWorker(self.dm, outbox=self.outbox, full_sync=not self.store.is_synced())
+            self.worker.start()
+            self.after(100, self._drain_results)
         except DSUProtocolError as dse:
-            print('sorry mate, looks like ya broke it :)')
-            self._errorMessage() #pop-up window telling user the error from server.
+            LOG.error('could not start the messenger', error=dse)
+            LOG.dump()
+            self._errorMessage(str(dse)) #pop-up window telling user the error from server.
         except Exception as e:
-            print(e)
+            LOG.error('could not start the messenger', error=repr(e))
+            LOG.dump()
 
 
     def add_user(self) -> None:
@@ -324,15 +607,53 @@ class MainApp(tk.Frame):
         if self.body.sender is not None: #makes sure a node is selected (recipient)
             message = self.body.get_text_entry()
             if message != "": #checks if user put something into the entry_editor
-                if not self.dm.send(message, self.body.sender):
-                    self._errorMessage() #pop-up window telling user the error from server.
+                #stored in the outbox and sent by the worker; the outcome comes back
+                #through _drain_results
+                self.worker.send(message, self.body.sender)
+
+
+    def _drain_results(self) -> None:
+        """
+        Handles what the background worker has finished since the last call, then
+        schedules itself again. Each call stops after DRAIN_BUDGET seconds, so a big
+        first download is merged a batch at a time without freezing the window.
+        """
+        deadline = time.perf_counter() + DRAIN_BUDGET
+        delay = 100
+        try:
+            while True:
+                if time.perf_counter() > deadline:
+                    #more is waiting; come back right after Tk has handled its events
+                    delay = 1
+                    break
+                try:
+                    result = self.worker.results.get_nowait()
+                except queue.Empty:
+                    break
+                if result[0] == 'new':
+                    self.body.add_messages(result[1])
+                elif result[0] == 'synced':
+                    if result[1]:
+                        self.store.mark_synced()
+                    self.body.set_status(None)
+                elif result[0] == 'error':
+                    self.body.set_status("Offline: " + result[1])
+                elif result[0] == 'sent' and not result[3]:
+                    self._errorMessage(result[4]) #pop-up window telling user the error from server.
+        finally:
+            #one bad result must not stop the window from syncing
+            self.after(delay, self._drain_results)
             
 
-    def _errorMessage(self) -> None:
+    def _errorMessage(self, message:str = None) -> None:
         """
         Generates a messagebox form the server telling user the error that occured.
+
+        :param message: the error; it travels with the worker's result, since self.dm
+                        belongs to the worker thread
+        :type message: str
         """
-        messagebox.showinfo(title='Heads up', message=self.dm.resp_msg["response"]["message"])
+        messagebox.showinfo(title='Heads up', message=message or 'could not reach the DS server')
             
 
     def _draw(self):
@@ -340,7 +661,7 @@ class MainApp(tk.Frame):
         Call only once, upon initialization to add widgets to root frame.
         """
         #The Body and Footer classes must be initialized and packed into root window.
-        self.body = Body(self.root, self.dm)
+        self.body = Body(self.root, self.dm, self.store)
         self.body.pack(fill=tk.BOTH, side=tk.TOP, expand=True)
 
         self.footer = Footer(self.root, addUser_callback=self.add_user, send_callback=self.send_message)
@@ -348,8 +669,19 @@ class MainApp(tk.Frame):
 
 
 if __name__ == "__main__":
+    # Opt-in UI diagnostics: DS_UI_PROFILE=1 (or a report path) measures event-loop lag and
+    # slow callbacks and writes ds_ui_profile.json on exit. It has to be installed before
+    # any widget is created so every callback is timed.
+    monitor = None
+    if os.environ.get('DS_UI_PROFILE'):
+        from ds_tkprofile import UIMonitor, DEFAULT_REPORT
+        report = os.environ['DS_UI_PROFILE']
+        monitor = UIMonitor(report_path=DEFAULT_REPORT if report == '1' else report).install()
+
     # Root window and title
     main = tk.Tk()
+    if monitor is not None:
+        monitor.start(main)
     main.title("ICS 32 Messenger")
 
     # Starting default size
@@ -366,3 +698,5 @@ if __name__ == "__main__":
     # the resizing behavior of the window changes.
     main.minsize(main.winfo_width(), main.winfo_height())
     main.mainloop()
+    if monitor is not None:
+        monitor.stop()